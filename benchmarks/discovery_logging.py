@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+"""
+Benchmark of file discovery throughput with logging off and on
+
+A tree of FILES files in DIRS directories is created, and the files are
+found and parsed (as do_action does before dispatching them) with the
+logger at INFO, where discovery and parsing log nothing, and at DEBUG,
+where every file is logged to a handler writing to os.devnull. The best
+throughput of REPEAT runs is printed for each level.
+
+usage: python benchmarks/discovery_logging.py [--files FILES] [--dirs DIRS]
+                                              [--repeat REPEAT]
+"""
+import argparse
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import scripter
+
+
+def make_tree(top, num_files, num_dirs):
+    '''creates num_files empty files spread over num_dirs directories'''
+    for i in xrange(num_files):
+        directory = os.path.join(top, 'dir%04d' % (i % num_dirs))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        open(os.path.join(directory, 'file%07d.txt' % i), 'w').close()
+
+
+def time_discovery(env, context, repeat):
+    '''returns (number of files, best time) of repeat discoveries'''
+    best = None
+    for _ in xrange(repeat):
+        start = time.time()
+        items = list(env._iter_sequence(**context))
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return len(items), best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--files', type=int, default=20000,
+                        help='number of files [default: 20000]')
+    parser.add_argument('--dirs', type=int, default=100,
+                        help='number of directories [default: 100]')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='runs at each logging level [default: 3]')
+    args = parser.parse_args()
+
+    top = tempfile.mkdtemp(prefix='scripter-benchmark-')
+    try:
+        make_tree(top, args.files, args.dirs)
+        sys.argv = [sys.argv[0], '--no-target', '--recursive', top]
+        env = scripter.Environment(doc=__doc__)
+        context = env.get_context()
+        # log everything to os.devnull, as the default handler would; it
+        # stays open for the records logged at exit
+        for handler in list(scripter.LOGGER.handlers):
+            scripter.LOGGER.removeHandler(handler)
+        handler = logging.StreamHandler(open(os.devnull, 'w'))
+        handler.setFormatter(logging.Formatter(
+            '[%(levelname)s/%(processName)s] %(message)s'))
+        handler.addFilter(scripter.AnnounceExitFilter(False))
+        scripter.LOGGER.addHandler(handler)
+
+        print '%d files in %d directories' % (args.files, args.dirs)
+        # warms up the page cache
+        scripter.LOGGER.setLevel(logging.WARNING)
+        list(env._iter_sequence(**context))
+        for name, level in (('off (INFO)', logging.INFO),
+                            ('on (DEBUG)', logging.DEBUG)):
+            scripter.LOGGER.setLevel(level)
+            found, elapsed = time_discovery(env, context, args.repeat)
+            print 'logging %-12s %7d files  %6.3f s  %9.0f files/s' % (
+                name, found, elapsed, found / elapsed)
+    finally:
+        shutil.rmtree(top)
+
+
+if __name__ == '__main__':
+    main()
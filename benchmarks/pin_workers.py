@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+"""
+Benchmark of --pin-workers on a memory-bandwidth-bound action
+
+The action copies a buffer larger than the CPU caches back and forth, so
+its speed depends on memory bandwidth and locality. It is run on TASKS
+dummy files through do_action, with and without --pin-workers (for each
+--pin-layout), and the best wall time of REPEAT runs is printed for each.
+
+usage: python benchmarks/pin_workers.py [-p NUM_CPUS] [--tasks TASKS]
+                                        [--size MB] [--passes N]
+                                        [--repeat REPEAT]
+"""
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import scripter
+
+# set when this script is run by itself as the scripter program
+CHILD_ENV = 'SCRIPTER_BENCHMARK_CHILD'
+
+
+def copy_buffers(fp, **context):
+    '''copies a buffer of --size MB back and forth --passes times'''
+    size = int(os.environ['SCRIPTER_BENCHMARK_SIZE']) << 20
+    src = bytearray(size)
+    dst = bytearray(size)
+    for _ in xrange(int(os.environ['SCRIPTER_BENCHMARK_PASSES'])):
+        dst[:] = src
+        src[:] = dst
+
+
+def run_child():
+    scripter.Environment(doc=__doc__).do_action(copy_buffers)
+
+
+def time_run(args, files, repeat):
+    '''returns the best wall time of repeat runs of this script on files'''
+    command = [sys.executable, os.path.abspath(__file__), '--no-target',
+               '--quiet'] + args + files
+    env = dict(os.environ)
+    env[CHILD_ENV] = '1'
+    best = None
+    with open(os.devnull, 'w') as devnull:
+        for _ in xrange(repeat):
+            start = time.time()
+            subprocess.check_call(command, env=env, stdout=devnull)
+            elapsed = time.time() - start
+            if best is None or elapsed < best:
+                best = elapsed
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('-p', '--num-cpus', type=int,
+                        default=len(scripter.available_cpus()),
+                        help='number of workers [default: all cpus]')
+    parser.add_argument('--tasks', type=int, default=None,
+                        help='number of tasks [default: 4 per worker]')
+    parser.add_argument('--size', type=int, default=64,
+                        help='size of the buffers, in MB [default: 64]')
+    parser.add_argument('--passes', type=int, default=20,
+                        help='copies of each buffer per task [default: 20]')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='runs of each configuration [default: 3]')
+    args = parser.parse_args()
+    tasks = args.tasks or 4 * args.num_cpus
+    os.environ['SCRIPTER_BENCHMARK_SIZE'] = str(args.size)
+    os.environ['SCRIPTER_BENCHMARK_PASSES'] = str(args.passes)
+
+    print 'cpus available: %s' % ','.join(
+        str(c) for c in sorted(scripter.available_cpus()))
+    print '%d workers, %d tasks, %d MB buffers, %d passes' % (
+        args.num_cpus, tasks, args.size, args.passes)
+    for layout in scripter.PIN_LAYOUTS:
+        mapping = scripter.cpu_layout(args.num_cpus, layout)
+        print '%s layout: %s' % (layout, '; '.join(
+            ','.join(str(c) for c in sorted(cpu_set)) if cpu_set else 'any'
+            for cpu_set in mapping))
+
+    directory = tempfile.mkdtemp(prefix='scripter-benchmark-')
+    try:
+        files = []
+        for i in xrange(tasks):
+            path = os.path.join(directory, 'task%05d.txt' % i)
+            open(path, 'w').close()
+            files.append(path)
+        configurations = [('not pinned', [])]
+        configurations.extend(('pinned, %s' % layout,
+                               ['--pin-workers', '--pin-layout', layout])
+                              for layout in scripter.PIN_LAYOUTS)
+        baseline = None
+        for name, pin_args in configurations:
+            elapsed = time_run(['-p', str(args.num_cpus)] + pin_args, files,
+                               args.repeat)
+            gigabytes = 2.0 * tasks * args.passes * args.size / 1024
+            if baseline is None:
+                baseline = elapsed
+            print '%-22s %7.2f s  %6.2f GB/s  %5.2fx' % (
+                name, elapsed, gigabytes / elapsed, baseline / elapsed)
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    if os.environ.get(CHILD_ENV):
+        run_child()
+    else:
+        main()
@@ -1,6 +1,9 @@
 #!/usr/bin/env python
 # See `Environment.__init__' definition for valid flags #
 import multiprocessing
+import multiprocessing.managers
+import multiprocessing.pool
+import multiprocessing.util
 import argparse
 import sys
 try:
@@ -10,14 +13,37 @@ except ImportError:
 import os
 import platform
 import glob
+import fnmatch
+import re
+import stat
 import signal
+import subprocess
+import threading
 import time
 import getpass
 import pprint
+import hashlib
+import heapq
 import itertools
+import tempfile
+import copy
+import shutil
+import contextlib
+import mmap
+import errno
+import atexit
+import json
+import collections
+import socket
+import select
+import struct
+import ctypes
+import ctypes.util
+import traceback
+import Queue
 from functools import partial
 from decorator import decorator
-from errno import ENOENT
+from errno import ENOENT, EEXIST
 import logging
 global PROGRAM_NAME
 PROGRAM_NAME = os.path.basename(sys.argv[0])
@@ -97,12 +123,17 @@ class Environment(object):
         self._script_version = version
         self._unprocessed_sequence = []
         self._sequence = []
+        self._num_streamed = 0
         self._context = None
         self._filename_parser = FilenameParser
         self._num_cpus = None
         self._config_reader = None
         self._config_writer = None
         self.allowed_extensions = None
+        self._name_filter = None
+        self._listing_batch_size = 256
+        self._poll_interval = 0.5
+        self._record_boundary = newline_boundary
         self.next_script = None
         self._is_first_time = True
         real_parser = self._build_default_parser(doc=doc, version=version)
@@ -113,6 +144,15 @@ class Environment(object):
             real_parser.add_argument('files', nargs='*',
                                      help='A list of files to act upon '
                                           '(wildcards ok)')
+            real_parser.add_argument('--files-from', metavar='PATH',
+                                     help='Also act upon the files listed in '
+                                          'PATH, one per line (- for stdin). '
+                                          'They are acted upon as they are '
+                                          'read')
+            real_parser.add_argument('-0', '--null', action='store_true',
+                                     help='Files listed in --files-from are '
+                                          'separated by NUL characters, as '
+                                          'with find -print0')
         context = vars(dummy_parser.parse_known_args()[0])
 
         # set up the logger
@@ -131,7 +171,6 @@ class Environment(object):
         LOGGER.setLevel(context['logging_level'])
 
         if context['logging_handler'] is not None:
-            LOGGER.addHandler(context['logging_handler'])
             debug("Using custom handler")
         debug("scripter logging successfully started")
         # emit logging success
@@ -192,12 +231,88 @@ class Environment(object):
                                 default=False,
                                 help='Recurse through any directories listed '
                                      'looking for valid files')
+            parser.add_argument('--include', action='append',
+                                metavar='PATTERN',
+                                help='Only act on files whose names match '
+                                     'PATTERN (wildcards ok, may be repeated)')
+            parser.add_argument('--exclude', action='append',
+                                metavar='PATTERN',
+                                help='Do not act on files whose names match '
+                                     'PATTERN (wildcards ok, may be repeated)')
             parser.add_argument('--no-action', '--do-nothing', '--dry-run',
                                 dest='allow_action', default=True,
                                 action='store_false',
                                 help="Don't act on files")
             parser.add_argument('--config',
                                 help='Use configuration in file foo')
+            parser.add_argument('--shard', type=shard_spec, metavar='K/N',
+                                help='Only act on shard K (1 to N) of the '
+                                     'files, split by a stable hash of their '
+                                     'paths (e.g. for array jobs)')
+            parser.add_argument('--shard-by-size', action='store_true',
+                                help='With --shard, balance shards by file '
+                                     'size instead of by number of files')
+            parser.add_argument('--split-size', type=size_spec,
+                                metavar='SIZE',
+                                help='Split files larger than SIZE bytes '
+                                     '(K, M or G suffixes ok) into parts of '
+                                     'about SIZE bytes, aligned to records, '
+                                     'and act on each part separately. '
+                                     'Output files returned by the action '
+                                     'are merged in order')
+            parser.add_argument('--share-results', type=size_spec,
+                                metavar='SIZE',
+                                help='Send results of at least SIZE bytes '
+                                     'from workers through shared memory '
+                                     'instead of pickling them')
+            parser.add_argument('--progress', action='store_true',
+                                help='Report progress, throughput and ETA '
+                                     '(periodically in the log if stderr is '
+                                     'not a terminal)')
+            parser.add_argument('--watch', action='store_true',
+                                help='Keep running, and act on files that '
+                                     'are new or have changed (see '
+                                     'do_watch)')
+            parser.add_argument('--watch-interval', type=float, default=2.0,
+                                metavar='SECONDS',
+                                help='With --watch, look for changes at most '
+                                     'every SECONDS [default: 2]')
+            parser.add_argument('--manifest', metavar='PATH',
+                                help='Write the list of files acted upon to '
+                                     'PATH')
+            parser.add_argument('--mkdir-threads', type=int, default=1,
+                                help='number of threads used to create '
+                                     'output directories (useful on network '
+                                     'filesystems) [default: 1]')
+            dgroup = parser.add_mutually_exclusive_group()
+            dgroup.add_argument('--serve', metavar='[HOST:]PORT',
+                                help='Act as a coordinator: serve the files '
+                                     'to workers started with --connect '
+                                     'instead of acting on them')
+            dgroup.add_argument('--connect', metavar='HOST:PORT',
+                                help='Act as a worker: act on files served '
+                                     'by the coordinator at HOST:PORT')
+            parser.add_argument('--authkey',
+                                default=os.environ.get('SCRIPTER_AUTHKEY'),
+                                help='Key shared by the coordinator and its '
+                                     'workers [default: $SCRIPTER_AUTHKEY]')
+            parser.add_argument('--worker-timeout', type=float, default=60,
+                                metavar='SECONDS',
+                                help='Requeue the tasks of workers not heard '
+                                     'from in SECONDS [default: 60]')
+            parser.add_argument('--max-children', type=int, metavar='N',
+                                help='Run at most N external programs '
+                                     '(see run_pipeline) at once, across all '
+                                     'workers')
+            parser.add_argument('--pin-workers', action='store_true',
+                                help='Pin each worker process to the cpus '
+                                     'chosen by --pin-layout')
+            parser.add_argument('--pin-layout', choices=PIN_LAYOUTS,
+                                default='round-robin',
+                                help='With --pin-workers, pin each worker to '
+                                     'a fixed core (round-robin) or to the '
+                                     'cores of one socket (socket) '
+                                     '[default: round-robin]')
         return parser
 
     def set_config_reader(self, reader):
@@ -216,53 +331,207 @@ class Environment(object):
         '''
         returns the sequence of FilenameParser objects for action
 
-        Running this more than once will not do anything
+        Running this more than once will not do anything. Files streamed
+        from --files-from by do_action, do_reduce or do_pipeline are not
+        kept, and are not part of it
         '''
         if self._is_first_time:
             self._update_sequence(**kwargs)
             self._is_first_time = False
         return self._sequence
 
-    def _update_sequence(self, files=[], recursive=False, **kwargs):
+    def _update_sequence(self, shard=None, shard_by_size=False, **kwargs):
         '''
         updates _sequence with files specified at command line (wildcards ok)
         '''
+        if shard is not None and shard_by_size:
+            sequence = list(self._iter_sequence(**kwargs))
+            self._sequence.extend(shard_sequence(sequence, shard[0],
+                                                 shard[1], by_size=True))
+        else:
+            self._sequence.extend(self._iter_sequence(shard=shard, **kwargs))
+        return
+
+    def _iter_sequence(self, files=[], recursive=False, include=None,
+                       exclude=None, files_from=None, null=False, shard=None,
+                       **kwargs):
+        '''
+        yields FilenameParser objects for the files specified at command line
+        (wildcards ok) and then those read from files_from, as they are found
+
+        the same file named twice (by overlapping patterns, symlinks or
+        hard links) is only yielded once. If shard is (K, N), only the items
+        in shard K of N are yielded (see shard_sequence)
+        '''
+        if shard is not None:
+            for item in self._iter_sequence(files, recursive, include,
+                                            exclude, files_from, null,
+                                            **kwargs):
+                if _shard_of(item, shard[1]) == shard[0] - 1:
+                    yield item
+            return
         debug('Updating sequence of files...')
         debug('Checking for user-specified files...')
-        # process wildcards as needed
-        unprocessed_files = []
-        for item in _iter_except(files.pop, IndexError):
-            files = glob.glob(item)
-            if len(files) == 1:
-                unprocessed_files.append(files[0])
-            elif len(files) > 1:
-                unprocessed_files.extend(files)
         if self.allowed_extensions is not None:
             debug('Valid file extensions are %s',
                   ' '.join(self.allowed_extensions))
-        if len(unprocessed_files) > 0:
-            debug('Found the following files:')
-            debug(pformat_list(unprocessed_files))
+        self._name_filter = compile_name_filter(include, exclude)
         filename_parser = self.get_filename_parser(**kwargs)
-        # note, filenames get processed backward
-        files = itertools.chain(_iter_except(unprocessed_files.pop,
-                                             IndexError))
-        sequence = self._sequence
-        for f in files:
-            if recursive and self._is_valid_dir(f):
-                debug('Searching for valid files in f')
-                for leaf in leaves(f):
-                    if self._is_valid_file(leaf):
-                        try:
-                            appendable = filename_parser(leaf)
-                            sequence.append(appendable)
-                        except InvalidFileException:
-                            pass
-            elif self._is_valid_file(f):
+        seen = set()
+        batch_size = self._listing_batch_size
+        candidates = self._iter_candidates(files, recursive)
+        if files_from is not None:
+            # streamed files are parsed one at a time so that nothing
+            # waits for the next name to be read
+            batch_size = 1
+            debug('Reading files from %s', files_from)
+            candidates = itertools.chain(candidates, self._iter_candidates(
+                read_file_list(files_from, null=null), recursive,
+                literal=True))
+        valid = ((path, st) for path, st in candidates
+                 if self._is_valid_file(path, st))
+        for directory, group in itertools.groupby(
+                valid, lambda candidate: os.path.dirname(candidate[0])):
+            names = []
+            for path, st in group:
+                inode = (st.st_dev, st.st_ino)
+                if inode in seen:
+                    debug("Skipping '%s'. It was already found.", path)
+                    continue
+                seen.add(inode)
+                names.append(os.path.basename(path))
+                if len(names) == batch_size:
+                    for item in self._parse_listing(filename_parser,
+                                                    directory, names):
+                        yield item
+                    names = []
+            if names:
+                for item in self._parse_listing(filename_parser, directory,
+                                                names):
+                    yield item
+
+    def _stream_sequence(self, context, create_dirs=True, manifest=None):
+        '''
+        yields FilenameParser objects as they are found, counting them in
+        _num_streamed and creating their output directories along the way
+
+        the items are not kept, so a manifest of millions of files does not
+        pile up in this process. If manifest is a path, the input file of
+        each item is written to it as it is found (see write_manifest)
+        '''
+        if context.get('shard_by_size') and context.get('shard'):
+            raise Usage('--shard-by-size cannot be used with --files-from')
+        output_dirs = set()
+        f = None
+        if manifest is not None:
+            f = open(manifest, 'w')
+        try:
+            for item in self._iter_sequence(**context):
+                self._num_streamed += 1
+                if f is not None:
+                    f.write(item.input_file)
+                    f.write('\n')
+                if create_dirs and item.output_dir not in output_dirs:
+                    output_dirs.add(item.output_dir)
+                    self._prepare_output_dirs([item])
+                yield item
+        finally:
+            if f is not None:
+                f.close()
+        self._is_first_time = False
+
+    def _iter_candidates(self, files, recursive=False, literal=False,
+                         visited_dirs=None):
+        '''
+        expands files (wildcards ok, ** matches any number of directories)
+        and yields (path, stat) for each match, walking into directories if
+        recursive
+
+        if literal, files are taken as they are, without wildcard expansion.
+        If visited_dirs is a list, the directories walked into are appended
+        to it (see _walk_files)
+        '''
+        for item in files:
+            if literal:
+                paths = [item]
+            elif '**' in item:
+                debug('Searching for files matching %s', item)
+                for candidate in _iter_recursive_glob(item, visited_dirs):
+                    yield candidate
+                continue
+            else:
+                paths = sorted(glob.glob(item))
+                directory = os.path.dirname(item)
+                if visited_dirs is not None and glob.has_magic(item) and \
+                        not glob.has_magic(directory):
+                    # where new matches would appear
+                    visited_dirs.append(directory)
+            for path in paths:
                 try:
-                    sequence.append(filename_parser(f))
-                except InvalidFileException:
-                    pass
+                    st = os.stat(path)
+                except OSError:
+                    debug("Skipping '%s'. It could not be stat'ed.", path)
+                    continue
+                if recursive and stat.S_ISDIR(st.st_mode) and \
+                        self._is_valid_dir(path):
+                    debug('Searching for valid files in %s', path)
+                    for candidate in _walk_files(
+                            path, visited_dirs=visited_dirs):
+                        yield candidate
+                else:
+                    if visited_dirs is not None and \
+                            not glob.has_magic(item):
+                        visited_dirs.append(os.path.dirname(path))
+                    yield path, st
+
+    def _candidate_matcher(self, files, recursive=False):
+        '''
+        returns match(path, st), which tells whether path would be found
+        by _iter_candidates(files, recursive) and is a valid file
+        '''
+        literals = set()
+        prefixes = []
+        patterns = []
+        for item in files:
+            if glob.has_magic(item):
+                patterns.append(_glob_regex(item).match)
+            elif recursive and os.path.isdir(item):
+                prefixes.append(os.path.join(item, ''))
+            else:
+                literals.add(item)
+        prefixes = tuple(prefixes)
+
+        def match(path, st):
+            if path not in literals and not path.startswith(prefixes) and \
+                    not any(m(path) is not None for m in patterns):
+                return False
+            return self._is_valid_file(path, st)
+        return match
+
+    @staticmethod
+    def _parse_listing(filename_parser, directory, names):
+        '''
+        returns FilenameParser objects for names (in directory) using
+        from_listing when the filename parser provides it
+        '''
+        from_listing = getattr(filename_parser.func, 'from_listing', None)
+        if from_listing is not None:
+            return from_listing(directory, names, *filename_parser.args,
+                                **filename_parser.keywords)
+        parsers = []
+        for name in names:
+            try:
+                parsers.append(filename_parser(os.path.join(directory, name)))
+            except InvalidFileException:
+                pass
+        return parsers
+
+    def set_record_boundary(self, find_boundary):
+        '''
+        use find_boundary(f, offset) instead of newline_boundary to align
+        the byte ranges made by --split-size to record boundaries
+        '''
+        self._record_boundary = find_boundary
         return
 
     def set_filename_parser(self, filename_parser):
@@ -282,7 +551,8 @@ class Environment(object):
         debug('Using %s with the following kwargs:',
               self._filename_parser.__name__)
         kwargs['target_dir'] = self.get_target_dir()
-        debug('\n%s', pprint.pformat(kwargs))
+        if LOGGER.isEnabledFor(logging.DEBUG):
+            debug('\n%s', pprint.pformat(kwargs))
         return partial(self._filename_parser, **kwargs)
 
     def override_num_cpus(self, num):
@@ -302,15 +572,25 @@ class Environment(object):
         else:
             return os.path.isdir(f)
 
-    def _is_valid_file(self, f):
+    def _is_valid_file(self, f, st=None):
         '''
         checks if a file is valid for processing
+
+        st may be the result of os.stat(f), if already known
         '''
-        if not os.path.isfile(f):
-            debug('Skipping %s. It is not a file.', _quote(f))
+        if st is None:
+            is_file = os.path.isfile(f)
+        else:
+            is_file = stat.S_ISREG(st.st_mode)
+        name = os.path.basename(f)
+        if not is_file:
+            debug("Skipping '%s'. It is not a file.", f)
+            return False
+        elif name.startswith('.'):
+            debug("Skipping hidden file '%s'", f)
             return False
-        elif os.path.basename(f).startswith('.'):
-            debug('Skipping hidden file %s', _quote(f))
+        elif self._name_filter is not None and not self._name_filter(name):
+            debug("Skipping '%s' because of --include/--exclude", f)
             return False
         elif self.allowed_extensions is None:
             return True
@@ -319,8 +599,8 @@ class Environment(object):
             if file_ext in self.allowed_extensions:
                 return True
             else:
-                debug('Skipping %s because file does not have a valid file '
-                      'extension', _quote(f))
+                debug("Skipping '%s' because file does not have a valid file "
+                      "extension", f)
                 return False
 
     def update_context(self, update_dict):
@@ -351,28 +631,68 @@ class Environment(object):
         executes an action
 
         actions should be functions that at least take FilenameParser objects
+
+        the files and options are taken from the command line, the action is
+        run with run and its results are printed. If it fails on any file,
+        the traceback is logged and we exit with status 1 once the other
+        files have been acted upon. To act on files from within a program,
+        use run instead
         '''
         context = self.get_context()
         LOGGER.setLevel(context['logging_level'])
+        if context.get('max_children') is not None:
+            set_max_children(context['max_children'])
 
         num_cpus = self._num_cpus or context['num_cpus'] or \
             multiprocessing.cpu_count()
         allow_action = context['allow_action']
 
-        sequence = self.get_sequence(**context)
-
-        max_cpus = len(sequence)
-        used_cpus = min([num_cpus, max_cpus]) or num_cpus or max_cpus or 1
+        if context.get('connect') is not None:
+            self._run_worker(action, context, num_cpus)
+            if not stay_open:
+                sys.exit(0)
+            return
+        if context.get('watch'):
+            return self.do_watch(action, stay_open=stay_open)
+
+        # files read with --files-from are acted upon as they are found
+        streaming = context.get('files_from') is not None and \
+            self._is_first_time
+        split_size = context.get('split_size')
+        if streaming:
+            sequence = self._stream_sequence(
+                context, create_dirs=allow_action,
+                manifest=context.get('manifest') if allow_action else None)
+            if split_size is not None:
+                sequence = split_sequence(sequence, split_size,
+                                          self._record_boundary)
+            max_cpus = -1
+            used_cpus = num_cpus
+        else:
+            sequence = self.get_sequence(**context)
+            if split_size is not None:
+                sequence = list(split_sequence(sequence, split_size,
+                                               self._record_boundary))
+            max_cpus = len(sequence)
+            used_cpus = min([num_cpus, max_cpus]) or num_cpus or max_cpus or 1
+            if len(sequence) == 0:
+                raise Usage('No input files specified or found. '
+                            'Nothing to do.')
 
-        if len(sequence) == 0:
-            raise Usage('No input files specified or found. Nothing to do.')
         if not allow_action:
             info('Test run. Nothing done.')
             info('I would have acted on the following files:')
             info("Using %d cpus. %d cpus were requested and "
                  "%d cpus were available", used_cpus, num_cpus or -1,
                  max_cpus or -1)
-            info(pformat_list(sequence))
+            if streaming:
+                for item in sequence:
+                    info('%r', item)
+            elif split_size is not None:
+                # repr shows the byte ranges
+                info('%s', pprint.pformat(sequence))
+            elif LOGGER.isEnabledFor(logging.INFO):
+                info(pformat_list(sequence))
             sys.exit(0)
 
         debug('Debugging mode enabled')
@@ -381,9 +701,10 @@ class Environment(object):
         if self._config_writer is not None:
             self._config_writer(**context)
 
-        # Create output directory if it doesn't exist
-        for item in sequence:
-            item.check_output_dir(item.output_dir)
+        # Create output directories if they don't exist
+        if not streaming:
+            self._prepare_output_dirs(sequence,
+                                      context.get('mkdir_threads', 1))
 
         effectiveLevel = -1
         try:
@@ -391,33 +712,677 @@ class Environment(object):
         except TypeError:
             pass
 
-        if used_cpus == 1:
-            debug('multiprocessing disabled')
-            for item in sequence:
-                stdout = action(item, **context)
-                if not effectiveLevel >= 50 and stdout is not None:
-                    print >>sys.stdout, stdout
-        else:
-            signal.signal(signal.SIGCHLD, signal.SIG_DFL)
-            debug('multiprocessing enabled')
-            p = multiprocessing.Pool(processes=used_cpus)
-            debug('Initialized pool of %d workers', used_cpus)
-            results = [p.apply_async(action, (item,), context) for
-                       item in sequence]
-            # timeout allows keyboard interrupt, set > 1 year
-            stdouts = (result.get(999999999) for result in results)
+        failed = []
+        progress = None
+        if context.get('progress'):
+            if streaming:
+                progress = ProgressReporter()
+            else:
+                progress = ProgressReporter(len(sequence),
+                                            _total_size(sequence))
+
+        if context.get('serve') is not None:
+            stdouts = self._serve(sequence, context, progress, failed)
             stdouts_good = filter(lambda x: type(x) is str, stdouts)
-            if not effectiveLevel >= 50 and stdouts_good is not None:
+            if not effectiveLevel >= 50:
                 print >>sys.stdout, os.linesep.join(stdouts_good)
+        else:
+            # results made with share_result go in a directory of their
+            # own, removed at the end even if they were never released
+            shared_dir = _make_shared_dir(self.get_target_dir())
+            share_size = None
+            if used_cpus > 1:
+                share_size = context.get('share_results')
+            if share_size is not None:
+                # large results come back through files in shared memory
+                action = partial(_share_large_result, action, share_size)
+
+            on_complete = None
+            if progress is not None:
+                on_complete = lambda result: progress.update(result.item)
+
+            def values():
+                ranges = []
+                for result in self.run(action, sequence, context,
+                                       processes=used_cpus,
+                                       create_dirs=False,
+                                       on_complete=on_complete):
+                    if result.error is not None:
+                        # repr shows the byte range of parts
+                        error('Action failed on %r:\n%s', result.item,
+                              result.error)
+                        failed.append(result.item)
+                    elif result.item.part is not None:
+                        # yielded once the parts have been merged
+                        ranges.append((result.item, result.value))
+                    else:
+                        yield result.value
+                for value in merge_range_outputs(
+                        ranges, failed=[str(item) for item in failed]):
+                    yield value
+            results = values()
+            try:
+                # without workers, any result but None is printed
+                _write_shared_results(results, quiet=effectiveLevel >= 50,
+                                      print_all=used_cpus == 1)
+            finally:
+                # stops the workers first if we did not get to the end
+                results.close()
+                _remove_shared_dir(shared_dir)
+        if progress is not None:
+            progress.finish()
+
+        if streaming:
+            num_files = self._num_streamed
+            if num_files == 0:
+                raise Usage('No input files specified or found. '
+                            'Nothing to do.')
+        else:
+            num_files = len(self._sequence)
+            if context.get('manifest') is not None:
+                write_manifest(context['manifest'], self._sequence)
+
+        if failed:
+            error('The action failed on %d of %d files', len(failed),
+                  num_files)
+            sys.exit(1)
 
         if self.next_script is not None:
             return self.execute_next_script()
         if not stay_open:
             sys.exit(0)
 
+    def run(self, action, files, context=None, processes=None, ordered=True,
+            create_dirs=True, on_complete=None):
+        '''
+        runs action on each of files and lazily yields an ActionResult
+        (item, value, elapsed, error) for each
+
+        files may be file names (taken as they are, without wildcards) or
+        FilenameParser objects, and is consumed as the workers need it.
+        context is passed as keyword arguments to action and the filename
+        parser. By default it is the command line's (see get_context); when
+        it is given, nothing is read from the command line, so run can be
+        called for batch after batch by a long-lived program. With
+        processes=1 (default: the number of CPUs), action is run in this
+        process. Results are in the order of files unless ordered is False;
+        on_complete(result), if given, is called as each one finishes,
+        whatever the order. If action raises an exception or a file is not
+        valid, error is the traceback and the run goes on. An exception
+        raised by files itself is raised once the results before it have
+        been yielded
+        '''
+        if context is None:
+            context = self.get_context()
+        elif 'target_dir' not in context:
+            context = dict(context, target_dir=self.get_target_dir())
+        if processes is None:
+            processes = self._num_cpus or multiprocessing.cpu_count()
+        items = self._iter_items(files, context, create_dirs)
+        task_context = _task_context(context)
+        if processes == 1:
+            debug('multiprocessing disabled')
+            for item in items:
+                if isinstance(item, ActionResult):
+                    if on_complete is not None:
+                        on_complete(item)
+                    yield item
+                    continue
+                index, value, elapsed, tb = _run_indexed(action, (0, item),
+                                                         task_context)
+                result = ActionResult(item, value, elapsed, tb)
+                if on_complete is not None:
+                    on_complete(result)
+                yield result
+            return
+
+        debug('multiprocessing enabled')
+        try:
+            signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        except ValueError:
+            # not in the main thread
+            pass
+        # items stay here; workers get them with an index and send back
+        # only the index with the value
+        pending = {}
+        # files is iterated by the pool's task thread, which would swallow
+        # its errors
+        failure = []
+
+        def tasks():
+            try:
+                for index, item in enumerate(items):
+                    pending[index] = item
+                    if isinstance(item, ActionResult):
+                        yield index, None
+                    else:
+                        yield index, item
+            except Exception:
+                failure.append(sys.exc_info())
+        p, listener = self._start_pool(processes, context)
+        finished = False
+        # results are taken as they finish; when ordered, those that
+        # finish before earlier ones wait here
+        finished_early = {}
+        next_index = 0
+        try:
+            results = p.imap_unordered(partial(_run_indexed, action,
+                                               context=task_context), tasks())
+            for index, value, elapsed, tb in _iter_results(results):
+                result = pending.pop(index)
+                if not isinstance(result, ActionResult):
+                    result = ActionResult(result, value, elapsed, tb)
+                if on_complete is not None:
+                    on_complete(result)
+                if not ordered:
+                    yield result
+                    continue
+                finished_early[index] = result
+                while next_index in finished_early:
+                    yield finished_early.pop(next_index)
+                    next_index += 1
+            if failure:
+                exc_type, exc_value, exc_tb = failure[0]
+                raise exc_type, exc_value, exc_tb
+            finished = True
+        finally:
+            if finished:
+                self._stop_pool(p, listener)
+            else:
+                # the caller stopped early, interrupted us or files raised
+                self._terminate_pool(p, listener)
+
+    def _iter_items(self, files, context, create_dirs=True):
+        '''
+        yields a FilenameParser object for each of files, creating its
+        output directory if create_dirs, or an ActionResult with the
+        traceback for file names that are not valid
+        '''
+        filename_parser = partial(self._filename_parser, **context)
+        output_dirs = set()
+        for item in files:
+            if isinstance(item, basestring):
+                try:
+                    if not self._is_valid_file(item):
+                        raise InvalidFileException(
+                            '%s is not a valid file' % item)
+                    item = filename_parser(item)
+                except (IOError, OSError, InvalidFileException):
+                    yield ActionResult(item, None, 0.0,
+                                       traceback.format_exc())
+                    continue
+            if create_dirs and item.output_dir not in output_dirs:
+                output_dirs.add(item.output_dir)
+                self._prepare_output_dirs([item])
+            yield item
+
+    @staticmethod
+    def _prepare_output_dirs(sequence, threads=1):
+        '''
+        creates the output directories of every item in sequence once
+
+        items whose class overrides check_output_dir get one call per
+        distinct directory; the rest are created by make_output_dirs
+        '''
+        default_dirs = set()
+        custom_dirs = {}
+        for item in sequence:
+            if type(item).check_output_dir == FilenameParser.check_output_dir:
+                default_dirs.add(item.output_dir)
+            else:
+                custom_dirs.setdefault((type(item), item.output_dir), item)
+        make_output_dirs(default_dirs, threads=threads)
+        for (_, output_dir), item in custom_dirs.iteritems():
+            item.check_output_dir(output_dir)
+
+    def _start_pool(self, processes, context):
+        '''
+        starts a multiprocessing.Pool and the LogListener its workers log to
+
+        returns (pool, listener)
+        '''
+        log_queue = multiprocessing.Queue()
+        listener = LogListener(log_queue, LOGGER.handlers)
+        listener.start()
+        cpu_sets = None
+        if context.get('pin_workers'):
+            cpu_sets = _pinning_queue(processes,
+                                      context.get('pin_layout') or
+                                      'round-robin')
+        pool = multiprocessing.Pool(processes=processes,
+                                    initializer=_init_worker,
+                                    initargs=(log_queue, cpu_sets,
+                                              _CHILD_SLOTS))
+        debug('Initialized pool of %d workers', processes)
+        return pool, listener
+
+    @staticmethod
+    def _stop_pool(pool, listener):
+        '''
+        lets the workers of pool exit, then stops listener once every
+        record they sent has been handled
+        '''
+        pool.close()
+        pool.join()
+        listener.stop()
+
+    @staticmethod
+    def _terminate_pool(pool, listener):
+        '''
+        stops the workers of pool right away, e.g. after an error
+
+        a worker may be killed while it holds the lock of the log queue, so
+        the listener is only waited for briefly
+        '''
+        pool.terminate()
+        pool.join()
+        listener.stop(timeout=1.0)
+
+    @exit_on_Usage
+    def do_reduce(self, action, reducer, chunk_size=None):
+        '''
+        executes an action and combines its results with reducer
+
+        reducer(a, b) must be associative and, like action, picklable. The
+        results of each chunk of chunk_size items are combined as a tree
+        inside the workers, so the parent only combines one partial result
+        per chunk. Results are combined in sequence order, and None results
+        are skipped. Returns the combined result (None if there was none).
+        With --no-action, the files are listed and we exit
+        '''
+        context = self.get_context()
+        LOGGER.setLevel(context['logging_level'])
+        num_cpus = self._num_cpus or context['num_cpus'] or \
+            multiprocessing.cpu_count()
+        if not context['allow_action']:
+            sequence = self.get_sequence(**context)
+            info('Test run. Nothing done.')
+            info('I would have acted on the following files:')
+            if LOGGER.isEnabledFor(logging.INFO):
+                info(pformat_list(sequence))
+            sys.exit(0)
+        if context.get('files_from') is not None and self._is_first_time:
+            sequence = self._stream_sequence(context)
+            chunk_size = chunk_size or 64
+        else:
+            sequence = self.get_sequence(**context)
+            if len(sequence) == 0:
+                raise Usage('No input files specified or found. '
+                            'Nothing to do.')
+            self._prepare_output_dirs(sequence,
+                                      context.get('mkdir_threads', 1))
+            chunk_size = chunk_size or \
+                max(1, len(sequence) // (4 * num_cpus))
+        chunks = _iter_chunks(sequence, chunk_size)
+        task_context = _task_context(context)
+        if num_cpus == 1:
+            debug('multiprocessing disabled')
+            return tree_reduce(reducer, (_reduce_chunk(action, reducer, chunk,
+                                                       task_context)
+                                         for chunk in chunks))
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        p, listener = self._start_pool(num_cpus, context)
+        finished = False
+        try:
+            partials = p.imap(partial(_reduce_chunk, action, reducer,
+                                      context=task_context), chunks)
+            result = tree_reduce(reducer, _iter_results(partials))
+            finished = True
+            return result
+        finally:
+            if finished:
+                self._stop_pool(p, listener)
+            else:
+                # an action or the reducer failed, or we were interrupted
+                self._terminate_pool(p, listener)
+
+    def _serve(self, sequence, context, progress=None, failed=None):
+        '''
+        serves sequence to workers started with --connect until every item
+        has been acted upon, and returns the results in order
+
+        the items the action failed on are appended to failed
+        '''
+        address = parse_address(context['serve'])
+        coordinator = Coordinator(sequence, context,
+                                  worker_timeout=context['worker_timeout'],
+                                  progress=progress)
+        manager = _CoordinatorManager(address=address,
+                                      authkey=_authkey(context))
+        _CoordinatorManager.register('get_coordinator',
+                                     callable=lambda: coordinator,
+                                     exposed=Coordinator.exposed)
+        server = manager.get_server()
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        info('Serving %d tasks on %s:%d', len(coordinator), *server.address)
+        results = coordinator.wait()
+        if failed is not None:
+            failed.extend(coordinator.failed)
+        return results
+
+    def _run_worker(self, action, context, num_cpus):
+        '''
+        pulls tasks from the coordinator at --connect and runs action on
+        them with a local pool of num_cpus workers until none are left
+        '''
+        address = parse_address(context['connect'], default_host='localhost')
+        manager = _CoordinatorManager(address=address,
+                                      authkey=_authkey(context))
+        _CoordinatorManager.register('get_coordinator')
+        # the pool is started first: processes forked while we hold a proxy
+        # would need the coordinator to still be up when they exit
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        p, listener = self._start_pool(num_cpus, context)
+        stopped = threading.Event()
+        try:
+            manager.connect()
+            coordinator = manager.get_coordinator()
+            worker_id = '%s:%d' % (socket.gethostname(), os.getpid())
+            remote_context = coordinator.get_context()
+            info('Connected to %s:%d as %s', address[0], address[1],
+                 worker_id)
+        except BaseException:
+            self._terminate_pool(p, listener)
+            raise
+
+        # heartbeats keep us alive while long tasks run
+        def heartbeat():
+            while not stopped.wait(context['worker_timeout'] / 3.0):
+                try:
+                    coordinator.heartbeat(worker_id)
+                except _DISCONNECTED:
+                    return
+        heartbeat_thread = threading.Thread(target=heartbeat)
+        heartbeat_thread.daemon = True
+        heartbeat_thread.start()
+
+        completed = Queue.Queue()
+        tracker = _TaskTracker(partial(_put_completed, completed),
+                               self._poll_interval)
+        in_flight = 0
+        try:
+            while True:
+                # lease tasks only for idle local workers, so that every
+                # leased task has started
+                if in_flight < num_cpus:
+                    tasks = coordinator.next_tasks(worker_id,
+                                                   num_cpus - in_flight)
+                    if tasks is None and in_flight == 0:
+                        break
+                    for task_id, item in tasks or []:
+                        tracker.submit(p, task_id, action, item,
+                                       remote_context)
+                        in_flight += 1
+                try:
+                    task_id, (value, tb) = completed.get(
+                        timeout=self._poll_interval)
+                except Queue.Empty:
+                    continue
+                in_flight -= 1
+                coordinator.put_result(worker_id, task_id, value, tb)
+        except _DISCONNECTED:
+            warning('Lost connection to coordinator at %s:%d', *address)
+        finally:
+            stopped.set()
+            tracker.close()
+            self._stop_pool(p, listener)
+
+    @exit_on_Usage
+    def do_pipeline(self, stages, stay_open=False):
+        '''
+        executes several actions, each on the output of the one before
+
+        stages is a list of actions or Stage objects. Every stage but the
+        last should return the file(s) it wrote, as file names or
+        FilenameParser objects (or a list of them). Each output is handed to
+        the next stage as soon as it is returned, so later stages start
+        while earlier ones are still running. Each stage has its own pool
+        of workers. The str results of the last stage are printed, in the
+        order they finish
+        '''
+        context = self.get_context()
+        LOGGER.setLevel(context['logging_level'])
+        if context.get('max_children') is not None:
+            set_max_children(context['max_children'])
+        num_cpus = self._num_cpus or context['num_cpus'] or \
+            multiprocessing.cpu_count()
+        stages = [stage if isinstance(stage, Stage) else Stage(stage)
+                  for stage in stages]
+        if len(stages) == 0:
+            raise Usage('No stages given. Nothing to do.')
+
+        if not context['allow_action']:
+            sequence = self.get_sequence(**context)
+            info('Test run. Nothing done.')
+            info('I would have run %d stages on the following files:',
+                 len(stages))
+            if LOGGER.isEnabledFor(logging.INFO):
+                info(pformat_list(sequence))
+            sys.exit(0)
+
+        if self._config_writer is not None:
+            self._config_writer(**context)
+
+        streaming = context.get('files_from') is not None and \
+            self._is_first_time
+        if streaming:
+            sequence = self._stream_sequence(context)
+        else:
+            sequence = self.get_sequence(**context)
+            if len(sequence) == 0:
+                raise Usage('No input files specified or found. '
+                            'Nothing to do.')
+            self._prepare_output_dirs(sequence,
+                                      context.get('mkdir_threads', 1))
+
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        pools = [self._start_pool(stage.processes or num_cpus, context)
+                 for stage in stages]
+        parser_kwargs = dict(context, target_dir=self.get_target_dir())
+        parsers = [partial(stage.filename_parser or self._filename_parser,
+                           **parser_kwargs) for stage in stages]
+        completed = Queue.Queue()
+        tracker = _TaskTracker(partial(_put_completed, completed),
+                               self._poll_interval)
+        task_context = _task_context(context)
+
+        def submit(index, item):
+            tracker.submit(pools[index][0], (index, item),
+                           stages[index].action, item, task_context)
+
+        # the first stage is fed from another thread, so that outputs can
+        # move on while files are still being found
+        def feed():
+            count = 0
+            try:
+                for item in sequence:
+                    submit(0, item)
+                    count += 1
+            except BaseException:
+                # re-raised by the main thread
+                completed.put((None, sys.exc_info()))
+                return
+            completed.put(count)
+        feeder = threading.Thread(target=feed)
+        feeder.daemon = True
+        feeder.start()
+
+        output_dirs = set()
+        results = []
+        failed = 0
+        outstanding = 0
+        fed = False
+        finished = False
+        try:
+            while not fed or outstanding > 0:
+                # timeout allows keyboard interrupt, set > 1 year
+                message = completed.get(timeout=999999999)
+                if type(message) is int:
+                    fed = True
+                    outstanding += message
+                    continue
+                elif message[0] is None:
+                    exc_type, exc_value, exc_tb = message[1]
+                    raise exc_type, exc_value, exc_tb
+                (index, item), (value, tb) = message
+                outstanding -= 1
+                if tb is not None:
+                    error('Stage %d failed on %s:\n%s', index + 1, item, tb)
+                    failed += 1
+                    continue
+                elif index == len(stages) - 1:
+                    results.append(value)
+                    continue
+                try:
+                    outputs = _stage_outputs(value, parsers[index + 1])
+                except (IOError, OSError), err:
+                    error('Stage %d failed on %s: it returned %s', index + 1,
+                          item, err)
+                    failed += 1
+                    continue
+                for output in outputs:
+                    if output.output_dir not in output_dirs:
+                        output_dirs.add(output.output_dir)
+                        self._prepare_output_dirs([output])
+                    submit(index + 1, output)
+                    outstanding += 1
+            finished = True
+        finally:
+            tracker.close()
+            for pool, listener in pools:
+                if finished:
+                    self._stop_pool(pool, listener)
+                else:
+                    self._terminate_pool(pool, listener)
+
+        if streaming and self._num_streamed == 0:
+            raise Usage('No input files specified or found. Nothing to do.')
+        if LOGGER.getEffectiveLevel() < 50:
+            print >>sys.stdout, os.linesep.join(
+                filter(lambda x: type(x) is str, results))
+        if failed:
+            error('The pipeline failed on %d files', failed)
+            sys.exit(1)
+        if not stay_open:
+            sys.exit(0)
+
+    @exit_on_Usage
+    def do_watch(self, action, interval=None, stay_open=False):
+        '''
+        executes an action on files as they arrive, until SIGINT, SIGTERM
+        or SIGHUP
+
+        the files and directories given at the command line (with -r, or
+        wildcards) are scanned at most every interval seconds (by default,
+        --watch-interval) and action is run on the valid files that are new
+        or have changed, once they stop changing (see FileWatcher). The
+        pool of workers is kept between scans. str results are printed as
+        they finish; failures are logged and watching goes on. On a signal,
+        actions already started are allowed to finish
+        '''
+        context = self.get_context()
+        LOGGER.setLevel(context['logging_level'])
+        if context.get('max_children') is not None:
+            set_max_children(context['max_children'])
+        for option in ('files_from', 'serve', 'connect', 'split_size'):
+            if context.get(option) is not None:
+                raise Usage('--%s cannot be used with --watch' %
+                            option.replace('_', '-'))
+        files = context.get('files')
+        if not files:
+            raise Usage('No files or directories to watch.')
+        interval = interval or context.get('watch_interval') or 2.0
+        num_cpus = self._num_cpus or context['num_cpus'] or \
+            multiprocessing.cpu_count()
+        allow_action = context['allow_action']
+        shard = context.get('shard')
+        quiet = LOGGER.getEffectiveLevel() >= 50
+
+        self._name_filter = compile_name_filter(context.get('include'),
+                                                context.get('exclude'))
+        filename_parser = self.get_filename_parser(**context)
+
+        def scan(visited_dirs):
+            for path, st in self._iter_candidates(files,
+                                                  context['recursive'],
+                                                  visited_dirs=visited_dirs):
+                if self._is_valid_file(path, st):
+                    yield path, st
+        watcher = FileWatcher(scan, interval,
+                              match=self._candidate_matcher(
+                                  files, context['recursive']))
+
+        # workers inherit the handler (and ignore it), so only this process
+        # stops; programs they run get the default handlers back
+        pid = os.getpid()
+
+        def stop(signum, frame):
+            if os.getpid() == pid:
+                info('Received signal %d, stopping', signum)
+                watcher.stop()
+        handlers = dict((signum, signal.signal(signum, stop))
+                        for signum in (signal.SIGINT, signal.SIGTERM,
+                                       signal.SIGHUP))
+
+        def done(item, result):
+            value, tb = result
+            if tb is not None:
+                error('Action failed on %s:\n%s', item, tb)
+            elif type(value) is str and not quiet:
+                print >>sys.stdout, value
+                sys.stdout.flush()
+
+        if self._config_writer is not None and allow_action:
+            self._config_writer(**context)
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        p, listener = self._start_pool(num_cpus, context)
+        info('Watching %s', ' '.join(files))
+        output_dirs = set()
+        task_context = _task_context(context)
+        tracker = _TaskTracker(done, self._poll_interval)
+        try:
+            for changed in watcher:
+                items = []
+                for directory, group in itertools.groupby(
+                        changed, lambda candidate:
+                        os.path.dirname(candidate[0])):
+                    items.extend(self._parse_listing(
+                        filename_parser, directory,
+                        [os.path.basename(path) for path, st in group]))
+                if shard is not None:
+                    items = [item for item in items
+                             if _shard_of(item, shard[1]) == shard[0] - 1]
+                if not items:
+                    continue
+                elif not allow_action:
+                    for item in items:
+                        info('I would have acted on %r', item)
+                    continue
+                info('Acting on %d new or changed files', len(items))
+                new_dirs = [item for item in items
+                            if item.output_dir not in output_dirs]
+                output_dirs.update(item.output_dir for item in new_dirs)
+                self._prepare_output_dirs(new_dirs,
+                                          context.get('mkdir_threads', 1))
+                for item in items:
+                    tracker.submit(p, item, action, item, task_context)
+        finally:
+            watcher.close()
+            self._stop_pool(p, listener)
+            # reports the last tasks that could not send their result
+            tracker.close()
+            for signum, handler in handlers.iteritems():
+                signal.signal(signum, handler)
+        if not stay_open:
+            sys.exit(0)
+
     def execute_next_script(self):
         '''
         execute the next script
+
+        not implemented, use do_pipeline to chain actions instead
         '''
         raise NotImplementedError
         os.execlp(self.next_script, "--find")
@@ -451,6 +1416,42 @@ def _quote(s):
     return ''.join(["'", s, "'"])
 
 
+class Stage(object):
+    '''
+    a stage of Environment.do_pipeline
+
+    action is called like any other action. processes defaults to --num-cpus,
+    and filename_parser (used for the files this stage receives from the
+    previous one) to the Environment's filename parser
+    '''
+    def __init__(self, action, processes=None, filename_parser=None):
+        self.action = action
+        self.processes = processes
+        self.filename_parser = filename_parser
+
+
+def _stage_outputs(value, filename_parser):
+    '''
+    turns what a pipeline stage returned into FilenameParser objects for
+    the next stage
+
+    raises IOError if a returned file does not exist
+    '''
+    if value is None:
+        return []
+    if not isinstance(value, (list, tuple)):
+        value = [value]
+    outputs = []
+    for output in value:
+        if isinstance(output, basestring):
+            try:
+                output = filename_parser(output)
+            except InvalidFileException:
+                continue
+        outputs.append(output)
+    return outputs
+
+
 class Usage(Exception):
     def __init__(self, *args):
         self.msg = ''.join(map(str, args))
@@ -477,74 +1478,125 @@ class FilenameParser(object):
     it must accept arbitrary **kwargs or it will be very unhappy
 
     It is recommend you customize this class for parsing filenames as needed
+
+    extra **kwargs (the context) are shared between parsers rather than
+    copied into each one, but can still be read as attributes
     """
+    # __dict__ is only created if other attributes are set
+    __slots__ = ('additional_args', '_context', 'input_file', 'input_dir',
+                 'file_extension', 'output_dir', 'protoname', 'offset',
+                 'length', 'part', '__dict__')
+
     @exit_on_Usage
     def __init__(self, filename, drop_parent_name=True,
                  target_dir=None, no_target=False,
                  target_input=False, *args, **kwargs):
         self.additional_args = args
-        self.__dict__.update(kwargs)
-
-        debug('Parsing filename %s', filename)
+        # context is shared, not copied; see __getattr__
+        self._context = kwargs
 
         self.set_input_file(filename)
 
-        input_dir = os.path.relpath(os.path.split(self.input_file)[0] or '.')
+        input_dir = _input_dir(os.path.split(self.input_file)[0])
         self.input_dir = input_dir
-        debug('Using %s as input_dir', input_dir)
         self.file_extension = os.path.splitext(self.input_file)[1][1:]
 
-        if no_target:
-            output_dir = '.'
-        elif target_input:
-            output_dir = input_dir
-        elif target_dir is None:
-            warning('Something went wrong setting the target directory. '
-                    'Using current directory instead')
-            output_dir = '.'
-        else:
-            if drop_parent_name:
-                path_by_folder = input_dir.split(os.sep)
-                if len(path_by_folder) == 1:
-                    if path_by_folder[0] in ['.', '..']:
-                        output_dir = target_dir
-                    else:
-                        output_dir = os.path.join(target_dir, input_dir)
-                else:
-                    while True:
-                        try:
-                            folder = path_by_folder.pop(0)
-                        except IndexError:
-                            output_dir = target_dir
-                            break
-                        if folder == '..':
-                            continue
-                        else:
-                            more_dirs = os.path.join(folder, *path_by_folder)
-                            output_dir = os.path.join(target_dir, more_dirs)
-            else:
-                output_dir = os.path.join(target_dir, input_dir)
-        self.output_dir = output_dir
-        debug('Using %s as output_dir', self.output_dir)
+        self.output_dir = _output_dir(input_dir, target_dir, drop_parent_name,
+                                      no_target, target_input)
+        debug('Parsed filename %s (input_dir %s, output_dir %s)',
+              filename, input_dir, self.output_dir)
 
         self.protoname = os.path.splitext(
             os.path.basename(self.input_file))[0]
+        # byte range of input_file to act on, see split
+        self.offset = self.length = self.part = None
+
+    @classmethod
+    def from_listing(cls, directory, names, drop_parent_name=True,
+                     target_dir=None, no_target=False, target_input=False,
+                     **kwargs):
+        """
+        returns a list of parsers, one for each file in names (basenames of
+        files in directory)
+
+        input_dir and output_dir are derived once for the whole listing.
+        Subclasses are constructed one by one, so that every hook they
+        override (__init__, set_input_file...) is called, and names raising
+        InvalidFileException are skipped
+        """
+        if cls is not FilenameParser:
+            parsers = []
+            for name in names:
+                try:
+                    parsers.append(cls(os.path.join(directory, name),
+                                       drop_parent_name=drop_parent_name,
+                                       target_dir=target_dir,
+                                       no_target=no_target,
+                                       target_input=target_input, **kwargs))
+                except InvalidFileException:
+                    pass
+            return parsers
+        input_dir = _input_dir(directory)
+        output_dir = _output_dir(input_dir, target_dir, drop_parent_name,
+                                 no_target, target_input)
+        debug('Parsing %d filenames in %s (output_dir %s)', len(names),
+              directory, output_dir)
+        parsers = []
+        for name in names:
+            parser = cls.__new__(cls)
+            parser.additional_args = ()
+            parser._context = kwargs
+            parser.input_file = os.path.join(directory, name)
+            parser.input_dir = input_dir
+            protoname, ext = os.path.splitext(name)
+            parser.file_extension = ext[1:]
+            parser.output_dir = output_dir
+            parser.protoname = protoname
+            parser.offset = parser.length = parser.part = None
+            parsers.append(parser)
+        return parsers
+
+    def __getattr__(self, name):
+        # only called when normal lookup fails: fall back on the context
+        if name.startswith('_'):
+            raise AttributeError(name)
+        try:
+            return self._context[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __getstate__(self):
+        state = {}
+        for name in FilenameParser.__slots__[:-1]:
+            try:
+                state[name] = object.__getattribute__(self, name)
+            except AttributeError:
+                pass
+        # attributes set by subclasses or users
+        state.update(getattr(self, '__dict__', {}))
+        return state
+
+    def __setstate__(self, state):
+        for name, value in state.iteritems():
+            setattr(self, name, value)
 
     def __str__(self):
         return self.input_file
 
     def __repr__(self):
+        if self.part is not None:
+            return '%s[%d:%d]' % (self.input_file, self.offset,
+                                  self.offset + self.length)
         return self.input_file
 
     def set_input_file(self, filename):
-        debug('Checking for %s ...', filename)
         assert_path(filename)
         self.input_file = filename
 
     def check_output_dir(self, output_dir):
         # Make the output directory, complain if we fail
         if os.path.exists(output_dir):
-            debug('Output directory %s already exists', _quote(output_dir))
+            debug("Output directory '%s' already exists", output_dir)
         else:
             debug('Creating directory "%s"', output_dir)
             os.makedirs(output_dir, mode=0755)
@@ -552,75 +1604,968 @@ class FilenameParser(object):
                 raise IOError('Could not create directory %s' % output_dir)
 
     def with_extension(self, ext):
-        '''Path to output file with extension'''
+        '''
+        Path to output file with extension
+
+        parts made by split get a .partNNNNN suffix before the extension
+        '''
+        if self.part is not None:
+            return os.extsep.join([self.protoname, 'part%05d' % self.part,
+                                   ext])
         return os.extsep.join([self.protoname, ext])
 
+    def split(self, chunk_size, find_boundary=None):
+        '''
+        returns copies of this parser covering consecutive byte ranges
+        (offset, length) of input_file of about chunk_size bytes each,
+        aligned to record boundaries (see record_ranges)
 
-@exit_on_Usage
-def leaves(dir_or_file, allow_symlinks=True, ignore_hidden_files=True,
-           max_depth=None):
-    '''takes as input a VALID path and descends into all directories
+        files no larger than chunk_size are returned whole, as [self]
+        '''
+        ranges = record_ranges(self.input_file, chunk_size, find_boundary)
+        if len(ranges) <= 1:
+            return [self]
+        parts = []
+        for i, (start, end) in enumerate(ranges):
+            part = copy.copy(self)
+            part.offset = start
+            part.length = end - start
+            part.part = i
+            parts.append(part)
+        return parts
+
+    @contextlib.contextmanager
+    def mapped_input(self):
+        '''
+        context manager giving read-only, zero-copy access to input_file
+        through mmap
 
-    WARNING:
-    this *will* get caught in an infinite loop if you have a symlink
-    which references a node above itself in tree
-    '''
-    def is_hidden(node):
-        return ignore_hidden_files and node.startswith('.')
+        the file is not read into memory: pages are loaded on demand from
+        the page cache, which is shared by every process mapping the same
+        file. Use buffer(data, offset, size) (or find, re, etc.) to avoid
+        copying; slicing copies. Empty files give an empty string
 
-    # Check sanity
-    if not os.path.exists(dir_or_file):
-        raise Usage(' '.join([dir_or_file, 'does not exist']))
+        for a part of a split file (see split), only its byte range is
+        mapped, and a buffer over that range is given instead of the mmap
+        '''
+        with open(self.input_file, 'rb') as f:
+            if self.offset is None:
+                if os.fstat(f.fileno()).st_size == 0:
+                    yield ''
+                    return
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                view = data
+            elif self.length == 0:
+                yield ''
+                return
+            else:
+                # mmap offsets must be multiples of the allocation
+                # granularity
+                start = self.offset - \
+                    self.offset % mmap.ALLOCATIONGRANULARITY
+                skip = self.offset - start
+                data = mmap.mmap(f.fileno(), skip + self.length,
+                                 access=mmap.ACCESS_READ, offset=start)
+                view = buffer(data, skip, self.length)
+        try:
+            yield view
+        finally:
+            data.close()
 
-    # Base case
-    if os.path.isfile(dir_or_file) and not dir_or_file.startswith('.'):
-        debug('Found file %s', dir_or_file)
-        return dir_or_file
+    def iter_blocks(self, block_size=1 << 20):
+        '''
+        yields input_file (or its byte range, see split) in blocks of up to
+        block_size bytes, as memoryviews over a single reused buffer
 
-    # Recurse
-    files = []
-    for node in os.listdir(dir_or_file):
-        node_path = os.path.join(dir_or_file, node)
-        if os.path.isdir(node_path):
-            if max_depth is None:
-                files.extend(leaves(node_path, allow_symlinks=allow_symlinks,
-                                    ignore_hidden_files=ignore_hidden_files,
-                                    max_depth=max_depth))
-            elif max_depth > 1:
-                files.extend(leaves(node_path, allow_symlinks=allow_symlinks,
-                                    ignore_hidden_files=ignore_hidden_files,
-                                    max_depth=max_depth-1))
-            elif max_depth == 1:
-                if os.path.isfile(node_path) and not is_hidden(node):
-                    files.append(node_path)
-            else:
-                break
-        elif os.path.isfile(node_path) and not is_hidden(node_path):
-            files.append(node_path)
-    return files
+        each block is only valid until the next one is read; copy it (with
+        block.tobytes()) to keep it
+        '''
+        buf = bytearray(block_size)
+        view = memoryview(buf)
+        remaining = self.length
+        with open(self.input_file, 'rb', 0) as f:
+            if self.offset is not None:
+                f.seek(self.offset)
+            while remaining is None or remaining > 0:
+                if remaining is None:
+                    n = f.readinto(buf)
+                else:
+                    n = f.readinto(view[:min(block_size, remaining)])
+                    remaining -= n
+                if not n:
+                    break
+                yield view[:n]
 
 
-def valid_directories(directory):
-    '''wrapper for glob.glob, enforces that output must be a valid directory'''
-    directories = [dir for dir in glob.glob(directory) if os.path.isdir(dir)]
-    directories.reverse  # use the newest version, in case we have foo-version
-    return directories
+def make_output_dirs(dirs, threads=1):
+    '''
+    creates each directory in dirs (and its parents) if it doesn't exist
 
+    duplicates and directories that are parents of other listed directories
+    are skipped, and no directory is stat'ed unless creating it fails.
+    Directories are created shallowest first, optionally on a pool of
+    threads
+    '''
+    dirs = sorted(set(os.path.normpath(d) for d in dirs),
+                  key=lambda d: d.split(os.sep))
+    # a parent sorts immediately before its first descendant
+    deepest = [d for d, after in itertools.izip_longest(dirs, dirs[1:])
+               if after is None or not after.startswith(d + os.sep)]
+    depth = lambda d: d.count(os.sep)
+    by_depth = itertools.groupby(sorted(deepest, key=depth), depth)
+    if threads > 1 and len(deepest) > 1:
+        pool = multiprocessing.pool.ThreadPool(threads)
+        try:
+            for _, level in by_depth:
+                pool.map(_make_dir, level)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for _, level in by_depth:
+            for d in level:
+                _make_dir(d)
 
-def path_to_executable(name, directories=None, max_depth=2, environ=None):
-    """
-    construct the path to the executable, search in order
 
-    the directory specified (or any directory that matches with Unix
-                             style pathname pattern expansion*)
-    then env PATH
-    then the current directory
-    then give up
+def _make_dir(output_dir):
+    try:
+        os.makedirs(output_dir, mode=0755)
+        debug('Created directory "%s"', output_dir)
+    except OSError, err:
+        if err.errno != EEXIST or not os.path.isdir(output_dir):
+            raise IOError('Could not create directory %s' % output_dir)
 
-    *we reverse the order so that we will usually get the newest version
-    """
-    if environ is not None:
-        # try it first
+
+def size_spec(spec):
+    '''parses a size in bytes, with an optional K, M or G suffix'''
+    multipliers = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30}
+    spec = spec.strip().upper().rstrip('B')
+    try:
+        if spec and spec[-1] in multipliers:
+            return int(float(spec[:-1]) * multipliers[spec[-1]])
+        return int(spec)
+    except ValueError:
+        raise argparse.ArgumentTypeError('%s is not a valid size' % spec)
+
+
+def newline_boundary(f, offset):
+    '''
+    returns the offset of the first line starting at or after offset in the
+    open file f (the size of the file if there is none)
+    '''
+    position = offset - 1
+    f.seek(position)
+    while True:
+        block = f.read(65536)
+        if not block:
+            return position
+        i = block.find('\n')
+        if i != -1:
+            return position + i + 1
+        position += len(block)
+
+
+def record_ranges(path, chunk_size, find_boundary=None):
+    '''
+    divides path into consecutive (start, end) byte ranges of about
+    chunk_size bytes, each starting on a record boundary
+
+    find_boundary(f, offset) must return the offset of the first record
+    starting at or after offset in the open file f. It defaults to
+    newline_boundary
+    '''
+    if find_boundary is None:
+        find_boundary = newline_boundary
+    size = os.path.getsize(path)
+    offsets = [0]
+    with open(path, 'rb') as f:
+        position = chunk_size
+        while position < size:
+            boundary = find_boundary(f, position)
+            if boundary >= size:
+                break
+            if boundary > offsets[-1]:
+                offsets.append(boundary)
+            position = max(boundary, position) + chunk_size
+    offsets.append(size)
+    return zip(offsets[:-1], offsets[1:])
+
+
+def split_sequence(sequence, chunk_size, find_boundary=None):
+    '''
+    yields the items of sequence, replacing those larger than chunk_size
+    with their byte ranges (see FilenameParser.split)
+    '''
+    for item in sequence:
+        for part in item.split(chunk_size, find_boundary):
+            yield part
+
+
+def merge_files(paths, destination, remove=True):
+    '''
+    concatenates paths, in order, into destination, removing them if remove
+    '''
+    with open(destination, 'wb') as out:
+        for path in paths:
+            with open(path, 'rb') as f:
+                shutil.copyfileobj(f, out, 1 << 20)
+    if remove:
+        for path in paths:
+            os.remove(path)
+    return destination
+
+
+def _unsplit_name(path, part):
+    '''removes the .partNNNNN suffix added by with_extension'''
+    directory, name = os.path.split(path)
+    return os.path.join(directory,
+                        name.replace('%spart%05d' % (os.extsep, part), '', 1))
+
+
+def merge_range_outputs(results, failed=()):
+    '''
+    takes (item, result) pairs and merges the output files of the parts of
+    each split input
+
+    if the action returned an existing file for every part of an input,
+    the files are concatenated in order (see merge_files) into a file named
+    as the first part's without its .partNNNNN suffix, which replaces the
+    parts' results. Otherwise, or if the input is in failed (the action
+    failed on some of its parts), the parts' results are kept. Returns the
+    results, in order
+    '''
+    failed = set(failed)
+    merged = []
+    parts = collections.OrderedDict()
+    for item, result in results:
+        if item.part is None:
+            merged.append(result)
+        else:
+            parts.setdefault(item.input_file, []).append((item.part, result))
+    for input_file, outputs in parts.iteritems():
+        outputs = [output for _, output in sorted(outputs)]
+        if input_file in failed:
+            warning('Not merging the parts of %s: the action failed on some '
+                    'of them', input_file)
+            merged.extend(outputs)
+        elif all(isinstance(output, basestring) and os.path.isfile(output)
+               for output in outputs):
+            destination = _unsplit_name(outputs[0], 0)
+            debug('Merging %d parts of %s into %s', len(outputs), input_file,
+                  destination)
+            merged.append(merge_files(outputs, destination))
+        else:
+            merged.extend(outputs)
+    return merged
+
+
+def shard_spec(spec):
+    '''
+    parses a K/N shard specification into (K, N), with 1 <= K <= N
+    '''
+    try:
+        shard, num_shards = [int(x) for x in spec.split('/')]
+    except ValueError:
+        raise argparse.ArgumentTypeError('%s is not of the form K/N' % spec)
+    if not 1 <= shard <= num_shards:
+        raise argparse.ArgumentTypeError('shard %d is not between 1 and %d' %
+                                         (shard, num_shards))
+    return shard, num_shards
+
+
+def _shard_key(item):
+    '''the path of item relative to the current directory'''
+    return os.path.join(item.input_dir, os.path.basename(item.input_file))
+
+
+def _shard_of(item, num_shards):
+    '''the shard (0 to num_shards - 1) item belongs to, by path hash'''
+    digest = hashlib.md5(_shard_key(item)).hexdigest()
+    return int(digest[:8], 16) % num_shards
+
+
+def shard_sequence(sequence, shard, num_shards, by_size=False):
+    '''
+    returns the items of sequence in shard (1 to num_shards)
+
+    items are assigned by a stable hash of their relative path, so every
+    invocation given the same files agrees on the split. If by_size, items
+    are instead assigned largest first to the shard with the fewest bytes,
+    which needs the whole sequence but balances uneven file sizes
+    '''
+    if not by_size:
+        return [item for item in sequence
+                if _shard_of(item, num_shards) == shard - 1]
+    keyed = sorted(((-os.path.getsize(item.input_file), _shard_key(item),
+                     item) for item in sequence), key=lambda k: k[:2])
+    loads = [(0, i) for i in xrange(num_shards)]
+    selected = []
+    for neg_size, _, item in keyed:
+        load, i = heapq.heappop(loads)
+        if i == shard - 1:
+            selected.append(item)
+        heapq.heappush(loads, (load - neg_size, i))
+    return selected
+
+
+def _input_size(item):
+    if item.length is not None:
+        return item.length
+    try:
+        return os.path.getsize(item.input_file)
+    except OSError:
+        return 0
+
+
+def _total_size(sequence):
+    return sum(_input_size(item) for item in sequence)
+
+
+def _format_size(num_bytes):
+    for unit in ('B', 'KB', 'MB', 'GB', 'TB'):
+        if abs(num_bytes) < 1024 or unit == 'TB':
+            return '%.1f %s' % (num_bytes, unit)
+        num_bytes /= 1024.0
+
+
+def _format_duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return '%d:%02d:%02d' % (hours, minutes, seconds)
+
+
+class ProgressReporter(object):
+    """
+    reports how many items are done, files/s, bytes/s and an ETA
+
+    call update (or use callback with apply_async) as each item finishes.
+    Reports are rate-limited to one every interval seconds on a terminal,
+    where the status line is redrawn in place, and one every log_interval
+    seconds in the log otherwise. The ETA is weighted by input size when
+    total_bytes is known
+    """
+    def __init__(self, total=None, total_bytes=None, interval=0.5,
+                 log_interval=30, stream=None):
+        self.total = total
+        self.total_bytes = total_bytes
+        self.stream = stream or sys.stderr
+        try:
+            self.is_tty = self.stream.isatty()
+        except AttributeError:
+            self.is_tty = False
+        self._interval = interval if self.is_tty else log_interval
+        self.completed = 0
+        self.completed_bytes = 0
+        self.start = self._last_report = time.time()
+
+    def update(self, item=None, num_bytes=None):
+        """records that item (of num_bytes, by default its size) is done"""
+        self.completed += 1
+        if num_bytes is None and item is not None:
+            num_bytes = _input_size(item)
+        self.completed_bytes += num_bytes or 0
+        now = time.time()
+        if now - self._last_report >= self._interval:
+            self._last_report = now
+            self._report(now)
+
+    def callback(self, item, result=None):
+        """for apply_async(..., callback=partial(progress.callback, item))"""
+        self.update(item)
+
+    def status(self, now=None):
+        """returns the current status line"""
+        elapsed = max((now or time.time()) - self.start, 1e-6)
+        rate = self.completed / elapsed
+        byte_rate = self.completed_bytes / elapsed
+        if self.total is None:
+            done = '%d files' % self.completed
+        else:
+            done = '%d/%d files (%.1f%%)' % (
+                self.completed, self.total,
+                100.0 * self.completed / max(self.total, 1))
+        line = '%s, %.1f files/s, %s/s' % (done, rate,
+                                           _format_size(byte_rate))
+        if self.total_bytes and byte_rate > 0:
+            eta = (self.total_bytes - self.completed_bytes) / byte_rate
+        elif self.total is not None and rate > 0:
+            eta = (self.total - self.completed) / rate
+        else:
+            return line
+        return '%s, ETA %s' % (line, _format_duration(max(eta, 0)))
+
+    def _report(self, now):
+        if self.is_tty:
+            self.stream.write('\r%-79s' % self.status(now))
+            self.stream.flush()
+        else:
+            info('Progress: %s', self.status(now))
+
+    def finish(self):
+        """reports the final status"""
+        now = time.time()
+        if self.is_tty:
+            self._report(now)
+            self.stream.write('\n')
+            self.stream.flush()
+        info('Done: %s in %s', self.status(now),
+             _format_duration(now - self.start))
+
+
+def write_manifest(path, sequence):
+    '''writes the input file of each item in sequence to path, one per line'''
+    with open(path, 'w') as f:
+        for item in sequence:
+            f.write(item.input_file)
+            f.write('\n')
+
+
+def merge_manifests(paths, output=None):
+    '''
+    merges the manifests written by several runs (e.g. one per --shard) into
+    a sorted list of files, optionally written to output
+
+    files listed in more than one manifest are reported and kept once
+    '''
+    seen = set()
+    for path in paths:
+        for name in read_file_list(path):
+            if name in seen:
+                warning('%s is listed in more than one manifest', name)
+            seen.add(name)
+    merged = sorted(seen)
+    if output is not None:
+        with open(output, 'w') as f:
+            for name in merged:
+                f.write(name)
+                f.write('\n')
+    return merged
+
+
+def read_file_list(path, null=False, block_size=65536):
+    '''
+    yields the file names listed in path (- for stdin), one per line or,
+    if null, separated by NUL characters
+
+    names are yielded as soon as they can be read, so a list that is still
+    being written (e.g. piped from find) can be acted upon right away
+    '''
+    separator = '\0' if null else '\n'
+    if path == '-':
+        f = sys.stdin
+    else:
+        f = open(path, 'rb')
+    try:
+        fd = f.fileno()
+        remainder = ''
+        while True:
+            # os.read returns as soon as anything is available
+            block = os.read(fd, block_size)
+            if not block:
+                break
+            names = (remainder + block).split(separator)
+            remainder = names.pop()
+            for name in names:
+                if not null:
+                    name = name.rstrip('\r')
+                if name:
+                    yield name
+        if not null:
+            remainder = remainder.rstrip('\r')
+        if remainder:
+            yield remainder
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+
+def compile_name_filter(include=None, exclude=None):
+    '''
+    compiles lists of include and exclude wildcard patterns into a single
+    function that takes a file name and returns True if it should be kept
+
+    returns None if there are no patterns
+    '''
+    if not include and not exclude:
+        return None
+    include_match = exclude_match = None
+    if include:
+        include_match = re.compile(
+            '|'.join(fnmatch.translate(p) for p in include)).match
+    if exclude:
+        exclude_match = re.compile(
+            '|'.join(fnmatch.translate(p) for p in exclude)).match
+
+    def name_filter(name):
+        if include_match is not None and include_match(name) is None:
+            return False
+        return exclude_match is None or exclude_match(name) is None
+    return name_filter
+
+
+def _glob_regex(pattern):
+    '''
+    translates a wildcard pattern into a compiled regular expression
+
+    * and ? do not match os.sep, ** followed by os.sep matches any number of
+    directories and ** elsewhere matches anything
+    '''
+    sep = re.escape(os.sep)
+    not_sep = '[^%s]' % sep
+    regex = []
+    i, n = 0, len(pattern)
+    while i < n:
+        if pattern.startswith('**' + os.sep, i):
+            regex.append('(?:%s*%s)*' % (not_sep, sep))
+            i += 3
+        elif pattern.startswith('**', i):
+            regex.append('.*')
+            i += 2
+        elif pattern[i] == '*':
+            regex.append(not_sep + '*')
+            i += 1
+        elif pattern[i] == '?':
+            regex.append(not_sep)
+            i += 1
+        elif pattern[i] == '[' and pattern.find(']', i + 2) != -1:
+            j = pattern.find(']', i + 2)
+            chars = pattern[i + 1:j].replace('\\', '\\\\')
+            if chars.startswith('!'):
+                chars = '^' + chars[1:]
+            regex.append('[%s]' % chars)
+            i = j + 1
+        else:
+            regex.append(re.escape(pattern[i]))
+            i += 1
+    return re.compile(''.join(regex) + r'\Z')
+
+
+def _iter_recursive_glob(pattern, visited_dirs=None):
+    '''
+    yields (path, stat) for each regular file matching pattern, which may
+    contain ** (see _glob_regex)
+    '''
+    parts = pattern.split(os.sep)
+    static = list(itertools.takewhile(lambda p: not glob.has_magic(p),
+                                      parts[:-1]))
+    top = os.sep.join(static)
+    if static == ['']:
+        top = os.sep
+    match = _glob_regex(pattern).match
+    for path, st in _walk_files(top, visited_dirs=visited_dirs):
+        if match(path) is not None:
+            yield path, st
+
+
+def _walk_files(top, ignore_hidden_files=True, visited_dirs=None):
+    '''
+    yields (path, stat) for every regular file below top (the current
+    directory if top is empty), one directory at a time
+
+    each entry is stat'ed exactly once. Symlinks are followed, but each
+    directory is only visited once. Like leaves, hidden directories are
+    walked into, and only hidden files are skipped (if ignore_hidden_files).
+    If visited_dirs is a list, the directories are appended to it as they
+    are visited
+    '''
+    try:
+        st = os.stat(top or os.curdir)
+    except OSError:
+        return
+    visited = set([(st.st_dev, st.st_ino)])
+    directories = [top]
+    while directories:
+        directory = directories.pop()
+        if visited_dirs is not None:
+            visited_dirs.append(directory)
+        try:
+            names = os.listdir(directory or os.curdir)
+        except OSError, err:
+            warning('Could not list %s: %s', directory or os.curdir,
+                    err.strerror)
+            continue
+        subdirectories = []
+        for name in sorted(names):
+            path = os.path.join(directory, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                # e.g. a broken symlink
+                continue
+            if stat.S_ISDIR(st.st_mode):
+                inode = (st.st_dev, st.st_ino)
+                if inode not in visited:
+                    visited.add(inode)
+                    subdirectories.append(path)
+            elif stat.S_ISREG(st.st_mode) and \
+                    not (ignore_hidden_files and name.startswith('.')):
+                yield path, st
+        directories.extend(reversed(subdirectories))
+
+
+class FileWatcher(object):
+    """
+    reports the files found by scan that are new or have changed
+
+    scan(visited_dirs) should yield (path, stat) for every file to watch,
+    appending the directories it looked in to visited_dirs. A file is
+    reported once it has stopped changing, i.e. when its size and
+    modification time are the same in two scans in a row, and again each
+    time it changes. Scans are at least interval seconds apart.
+
+    On Linux, the directories are watched with inotify (if available), and
+    scans only happen once something changed in them. If match(path, stat)
+    tells which files scan would yield, those scans only list the
+    directories where something happened (and those of files that are
+    still changing), walking into new ones. The full scan is then repeated
+    every rescan_interval seconds, or if inotify lost events
+    """
+    def __init__(self, scan, interval=2.0, rescan_interval=60.0,
+                 use_inotify=True, match=None):
+        self._scan = scan
+        self._match = match
+        self.interval = interval
+        self.rescan_interval = rescan_interval
+        self._reported = {}
+        self._pending = {}
+        self._last_scan = self._last_full_scan = None
+        self._stopped = threading.Event()
+        self._inotify = None
+        if use_inotify:
+            try:
+                self._inotify = _Inotify()
+            except (OSError, AttributeError):
+                debug('inotify is not available, polling every %ss',
+                      interval)
+
+    def __iter__(self):
+        """yields the list of files (see poll) after each scan until stop"""
+        while not self._stopped.is_set():
+            yield self.poll()
+
+    def poll(self):
+        """
+        waits until the next scan is due, scans, and returns (path, stat)
+        for each file that is new or has changed, sorted by path
+        """
+        directories = None
+        if self._last_scan is not None:
+            directories = self._wait()
+        if self._stopped.is_set():
+            return []
+        self._last_scan = time.time()
+        visited_dirs = []
+        if directories is None:
+            self._last_full_scan = self._last_scan
+            found = dict(self._scan(visited_dirs))
+        else:
+            debug('Scanning %d directories', len(directories))
+            found = dict(self._scan_directories(directories, visited_dirs))
+        if self._inotify is not None:
+            self._inotify.watch(visited_dirs)
+
+        def scanned(path):
+            return directories is None or \
+                os.path.dirname(path) in directories
+        changed = []
+        pending = {}
+        for path, st in found.iteritems():
+            signature = (st.st_dev, st.st_ino, st.st_size, st.st_mtime)
+            if self._reported.get(path) == signature:
+                continue
+            elif self._pending.get(path) == signature:
+                self._reported[path] = signature
+                changed.append((path, st))
+            else:
+                pending[path] = signature
+        # files in directories that were not scanned are left as they were
+        for path, signature in self._pending.iteritems():
+            if path not in found and not scanned(path):
+                pending[path] = signature
+        self._pending = pending
+        # forget files that have gone away
+        for path in [path for path in self._reported
+                     if path not in found and scanned(path)]:
+            del self._reported[path]
+        changed.sort()
+        return changed
+
+    def stop(self):
+        """makes poll return (an empty list) and ends iteration"""
+        self._stopped.set()
+
+    def close(self):
+        if self._inotify is not None:
+            self._inotify.close()
+            self._inotify = None
+
+    def _wait(self):
+        """
+        waits until the next scan is due or stop is called, and returns
+        the directories to scan (None for a full scan)
+        """
+        now = time.time()
+        if self._inotify is not None and not self._pending:
+            # nothing is settling, so wait for something to happen
+            deadline = self._last_full_scan + self.rescan_interval
+            while now < deadline and not self._stopped.is_set():
+                # short timeouts so that stop is noticed
+                if self._inotify.wait(min(deadline - now, 1.0)):
+                    break
+                now = time.time()
+        self._stopped.wait(max(self._last_scan + self.interval - now, 0))
+        if self._inotify is None:
+            return None
+        # events until now are covered by the next scan
+        directories = self._inotify.read()
+        if directories is None or self._match is None or \
+                time.time() >= self._last_full_scan + self.rescan_interval:
+            return None
+        directories.update(os.path.dirname(path) for path in self._pending)
+        return directories
+
+    def _scan_directories(self, directories, visited_dirs):
+        """
+        yields (path, stat) for the matching files in directories, walking
+        into subdirectories that are not watched yet
+        """
+        for directory in sorted(directories):
+            try:
+                names = os.listdir(directory or os.curdir)
+            except OSError:
+                # it has gone away
+                continue
+            visited_dirs.append(directory)
+            for name in sorted(names):
+                if name.startswith('.'):
+                    continue
+                path = os.path.join(directory, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                if not stat.S_ISDIR(st.st_mode):
+                    candidates = [(path, st)]
+                elif path not in self._inotify:
+                    candidates = _walk_files(path, visited_dirs=visited_dirs)
+                else:
+                    continue
+                for candidate in candidates:
+                    if self._match(*candidate):
+                        yield candidate
+
+
+class _Inotify(object):
+    """
+    the directories watched with inotify(7), see FileWatcher
+
+    raises AttributeError (or OSError) where inotify is not available
+    """
+    # IN_ATTRIB, IN_CLOSE_WRITE, IN_MOVED_FROM, IN_MOVED_TO, IN_CREATE,
+    # IN_DELETE, IN_DELETE_SELF and IN_MOVE_SELF
+    _MASK = 0x4 | 0x8 | 0x40 | 0x80 | 0x100 | 0x200 | 0x400 | 0x800
+    _IN_Q_OVERFLOW = 0x4000
+    _IN_IGNORED = 0x8000
+    # struct inotify_event, followed by len bytes of name
+    _EVENT = struct.Struct('iIII')
+
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self.fd = libc.inotify_init()
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        self._directories = {}
+        self._descriptors = {}
+
+    def __contains__(self, directory):
+        return directory in self._descriptors
+
+    def watch(self, directories):
+        """
+        watches each of directories (again adding a directory that is
+        already watched does nothing)
+        """
+        for directory in directories:
+            wd = self._add_watch(self.fd, directory or os.curdir,
+                                 self._MASK)
+            if wd < 0:
+                debug('Could not watch %s: %s', directory or os.curdir,
+                      os.strerror(ctypes.get_errno()))
+                continue
+            self._directories[wd] = directory
+            self._descriptors[directory] = wd
+
+    def wait(self, timeout):
+        """
+        waits up to timeout seconds for events and returns whether there
+        are any
+        """
+        try:
+            return bool(select.select([self.fd], [], [], timeout)[0])
+        except select.error, err:
+            if err.args[0] != errno.EINTR:
+                raise
+            return False
+
+    def read(self):
+        """
+        reads the pending events and returns the set of directories they
+        happened in, or None if some events were lost
+        """
+        directories = set()
+        lost = False
+        while self.wait(0):
+            data = os.read(self.fd, 65536)
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, length = self._EVENT.unpack_from(data, offset)
+                offset += self._EVENT.size + length
+                if mask & self._IN_Q_OVERFLOW:
+                    lost = True
+                    continue
+                directory = self._directories.get(wd)
+                if directory is None:
+                    continue
+                directories.add(directory)
+                if mask & self._IN_IGNORED:
+                    # the directory is gone, and so is its watch
+                    del self._directories[wd]
+                    if self._descriptors.get(directory) == wd:
+                        del self._descriptors[directory]
+        if lost:
+            return None
+        return directories
+
+    def close(self):
+        os.close(self.fd)
+
+
+_INPUT_DIRS = {}
+_OUTPUT_DIRS = {}
+
+
+def _input_dir(dirname):
+    '''memoized os.path.relpath of a directory name (may be empty)'''
+    # relative to the current directory, which may change between runs
+    key = (os.getcwd(), dirname)
+    try:
+        return _INPUT_DIRS[key]
+    except KeyError:
+        input_dir = _INPUT_DIRS[key] = os.path.relpath(dirname or '.')
+        return input_dir
+
+
+def _output_dir(input_dir, target_dir, drop_parent_name=True,
+                no_target=False, target_input=False):
+    '''
+    memoized derivation of a FilenameParser's output_dir from its input_dir
+    '''
+    key = (input_dir, target_dir, drop_parent_name, no_target, target_input)
+    try:
+        return _OUTPUT_DIRS[key]
+    except KeyError:
+        pass
+    if no_target:
+        output_dir = '.'
+    elif target_input:
+        output_dir = input_dir
+    elif target_dir is None:
+        warning('Something went wrong setting the target directory. '
+                'Using current directory instead')
+        output_dir = '.'
+    else:
+        if drop_parent_name:
+            path_by_folder = input_dir.split(os.sep)
+            if len(path_by_folder) == 1:
+                if path_by_folder[0] in ['.', '..']:
+                    output_dir = target_dir
+                else:
+                    output_dir = os.path.join(target_dir, input_dir)
+            else:
+                while True:
+                    try:
+                        folder = path_by_folder.pop(0)
+                    except IndexError:
+                        output_dir = target_dir
+                        break
+                    if folder == '..':
+                        continue
+                    else:
+                        more_dirs = os.path.join(folder, *path_by_folder)
+                        output_dir = os.path.join(target_dir, more_dirs)
+        else:
+            output_dir = os.path.join(target_dir, input_dir)
+    _OUTPUT_DIRS[key] = output_dir
+    return output_dir
+
+
+@exit_on_Usage
+def leaves(dir_or_file, allow_symlinks=True, ignore_hidden_files=True,
+           max_depth=None):
+    '''takes as input a VALID path and descends into all directories
+
+    WARNING:
+    this *will* get caught in an infinite loop if you have a symlink
+    which references a node above itself in tree
+    '''
+    def is_hidden(node):
+        return ignore_hidden_files and node.startswith('.')
+
+    # Check sanity
+    if not os.path.exists(dir_or_file):
+        raise Usage(' '.join([dir_or_file, 'does not exist']))
+
+    # Base case
+    if os.path.isfile(dir_or_file) and not dir_or_file.startswith('.'):
+        debug('Found file %s', dir_or_file)
+        return dir_or_file
+
+    # Recurse
+    files = []
+    for node in os.listdir(dir_or_file):
+        node_path = os.path.join(dir_or_file, node)
+        if os.path.isdir(node_path):
+            if max_depth is None:
+                files.extend(leaves(node_path, allow_symlinks=allow_symlinks,
+                                    ignore_hidden_files=ignore_hidden_files,
+                                    max_depth=max_depth))
+            elif max_depth > 1:
+                files.extend(leaves(node_path, allow_symlinks=allow_symlinks,
+                                    ignore_hidden_files=ignore_hidden_files,
+                                    max_depth=max_depth-1))
+            elif max_depth == 1:
+                if os.path.isfile(node_path) and not is_hidden(node):
+                    files.append(node_path)
+            else:
+                break
+        elif os.path.isfile(node_path) and not is_hidden(node_path):
+            files.append(node_path)
+    return files
+
+
+def valid_directories(directory):
+    '''wrapper for glob.glob, enforces that output must be a valid directory'''
+    directories = [dir for dir in glob.glob(directory) if os.path.isdir(dir)]
+    directories.reverse  # use the newest version, in case we have foo-version
+    return directories
+
+
+def path_to_executable(name, directories=None, max_depth=2, environ=None):
+    """
+    construct the path to the executable, search in order
+
+    the directory specified (or any directory that matches with Unix
+                             style pathname pattern expansion*)
+    then env PATH
+    then the current directory
+    then give up
+
+    *we reverse the order so that we will usually get the newest version
+    """
+    if environ is not None:
+        # try it first
         try:
             path_to = _path_to_executable(os.environ[environ],
                                           directories=directories,
@@ -653,46 +2598,236 @@ def path_to_executable(name, directories=None, max_depth=2, environ=None):
         return path_to
 
 
-def _path_to_executable(name, directories=None, max_depth=2):
+def paths_to_executables(names, directories=None, max_depth=2):
+    """
+    resolves several executables at once, like path_to_executable
+
+    names found in the cache (see _path_to_executable) are not searched
+    for again, and each directory searched is listed once for all other
+    names, instead of checking every name in every directory. Returns a
+    dict mapping each name to its path (None if it could not be found)
+    """
+    directories = _as_list(directories)
+    paths = dict.fromkeys(names)
+    unresolved = set()
+    mtimes = {}
+    for name in paths:
+        try:
+            paths[name] = _cached_executable(name, directories, mtimes)
+        except KeyError:
+            unresolved.add(name)
+            continue
+        if paths[name] is None:
+            error("Could not find executable %s", name)
+    if not unresolved:
+        return paths
+    searched = []
     using_windows = platform.system() == 'Windows'
+    for directory in _search_directories(directories, searched):
+        try:
+            entries = set(os.listdir(directory))
+        except OSError:
+            continue
+        for name in list(unresolved):
+            for candidate in (name, name + '.exe'):
+                if candidate not in entries or \
+                        (candidate != name and not using_windows):
+                    continue
+                full_path = os.path.join(directory, candidate)
+                if is_valid_executable(full_path):
+                    paths[name] = full_path
+                    unresolved.discard(name)
+                    _cache_executable(name, directories, full_path,
+                                      searched)
+                    break
+        if not unresolved:
+            break
+    for name in unresolved:
+        try:
+            paths[name] = _path_to_executable(name, directories=directories,
+                                              max_depth=max_depth)
+        except StandardError:
+            error("Could not find executable %s", name)
+    return paths
+
+
+def _as_list(directories):
+    if directories is not None and type(directories) is not list:
+        return [directories]
+    return directories
+
+
+def _get_path():
+    try:
+        return os.environ['PATH']
+    except KeyError:
+        return os.defpath
+
 
-    #try specified directory
+def _search_directories(directories, searched):
+    """
+    yields the directories to search for executables, in order, and
+    records (directory, mtime) for each in searched
+    """
+    candidates = []
     if directories is not None:
-        if type(directories) is not list:
-            directories = [directories]
         for d in directories:
-            for directory in valid_directories(d):
-                full_path = os.path.join(directory, name)
-                if is_valid_executable(full_path):
-                    return full_path
-                if using_windows and is_valid_executable(full_path + '.exe'):
-                    return full_path + '.exe'
+            if glob.has_magic(d):
+                # a new match would change the parent directory
+                _record_mtime(searched, os.path.dirname(d) or os.curdir)
+            candidates.extend(valid_directories(d))
+    candidates.extend(_get_path().split(os.pathsep))
+    try:
+        candidates.append(sysconfig.get_path('scripts'))
+    except (NameError, AttributeError):
+        pass
+    for directory in candidates:
+        _record_mtime(searched, directory)
+        yield directory
 
-    #try PATH
+
+def _record_mtime(searched, directory):
     try:
-        PATH = os.environ['PATH']
-    except NameError:
-        try:
-            PATH = os.defpath
-        except NameError:
-            raise Usage("Could not determine PATH")
-    for p in PATH.split(os.pathsep):
-        full_path = os.path.join(p, name)
-        if is_valid_executable(full_path):
-            return full_path
-        if using_windows and is_valid_executable(full_path + '.exe'):
-            return full_path + '.exe'
+        searched.append((directory, os.stat(directory or os.curdir).st_mtime))
+    except OSError:
+        searched.append((directory, None))
+
+
+def _is_fresh(searched, mtimes=None):
+    """
+    checks that none of the searched directories have changed
+
+    mtimes may be a dict of the current mtime of directories, filled in as
+    they are stat'ed, so that several checks stat each directory once
+    """
+    for directory, mtime in searched:
+        if mtimes is not None and directory in mtimes:
+            current = mtimes[directory]
+        else:
+            try:
+                current = os.stat(directory or os.curdir).st_mtime
+            except OSError:
+                current = None
+            if mtimes is not None:
+                mtimes[directory] = current
+        if current != mtime:
+            return False
+    return True
+
+
+# (name, directories, PATH) -> (path or None, [(directory, mtime), ...])
+_EXECUTABLE_CACHE = {}
+_EXECUTABLE_CACHE_FILE = os.environ.get('SCRIPTER_EXECUTABLE_CACHE')
 
-    #try python scripts
+
+def _executable_cache_key(name, directories):
+    return (name, tuple(directories or ()), _get_path())
+
+
+def _cache_executable(name, directories, path, searched):
+    _EXECUTABLE_CACHE[_executable_cache_key(name, directories)] = \
+        (path, list(searched))
+
+
+def load_executable_cache(path):
+    """
+    loads executable locations saved by save_executable_cache
+
+    entries are checked against directory mtimes before use, so a stale
+    cache is harmless
+    """
+    try:
+        with open(path) as f:
+            entries = json.load(f)
+    except (IOError, ValueError):
+        debug('Could not load executable cache from %s', path)
+        return
+    for name, directories, PATH, found, searched in entries:
+        key = (name, tuple(directories), PATH)
+        _EXECUTABLE_CACHE.setdefault(key, (found, [tuple(s) for s in
+                                                   searched]))
+
+
+def save_executable_cache(path):
+    """
+    saves the executable locations found so far to path
+
+    the cache is written to a temporary file next to path and renamed
+    into place, so concurrent readers never see a partial file
+    """
+    entries = [list(key) + [found, searched] for key, (found, searched)
+               in _EXECUTABLE_CACHE.iteritems()]
+    tmp = None
+    try:
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path) or os.curdir,
+                                   prefix='.%s.' % os.path.basename(path))
+        with os.fdopen(fd, 'w') as f:
+            json.dump(entries, f)
+        os.rename(tmp, path)
+    except (IOError, OSError):
+        warning('Could not save executable cache to %s', path)
+        if tmp is not None and os.path.exists(tmp):
+            os.remove(tmp)
+
+
+if _EXECUTABLE_CACHE_FILE is not None:
+    load_executable_cache(_EXECUTABLE_CACHE_FILE)
+    atexit.register(save_executable_cache, _EXECUTABLE_CACHE_FILE)
+
+
+def _cached_executable(name, directories, mtimes=None):
+    """
+    returns the cached path of name (None if it was not found), or raises
+    KeyError if it is not cached or a directory searched has changed
+
+    mtimes is passed to _is_fresh, so that a batch of lookups stats each
+    directory once
+    """
+    path, searched = _EXECUTABLE_CACHE[_executable_cache_key(name,
+                                                             directories)]
+    if not _is_fresh(searched, mtimes):
+        raise KeyError(name)
+    return path
+
+
+def _path_to_executable(name, directories=None, max_depth=2):
+    """
+    cached lookup of an executable, see path_to_executable
+
+    lookups (including failed ones) are cached per process, and reused
+    until one of the directories searched is modified
+    """
+    directories = _as_list(directories)
+    key = _executable_cache_key(name, directories)
+    try:
+        path = _cached_executable(name, directories)
+    except KeyError:
+        pass
+    else:
+        if path is None:
+            raise StandardError
+        return path
+    searched = []
     try:
-        script_path = sysconfig.get_path('scripts')
-        full_path = os.path.join(script_path, name)
+        path = _search_executable(name, directories, max_depth, searched)
+    except StandardError:
+        if platform.system() != 'Windows':
+            _EXECUTABLE_CACHE[key] = (None, searched)
+        raise
+    _EXECUTABLE_CACHE[key] = (path, searched)
+    return path
+
+
+def _search_executable(name, directories, max_depth, searched):
+    using_windows = platform.system() == 'Windows'
+
+    # try specified directories, then PATH, then python scripts
+    for directory in _search_directories(directories, searched):
+        full_path = os.path.join(directory, name)
         if is_valid_executable(full_path):
             return full_path
         if using_windows and is_valid_executable(full_path + '.exe'):
             return full_path + '.exe'
-    except (NameError, AttributeError):
-        pass
 
     # check if we're on Windows, and try a little harder
     if using_windows:
@@ -724,6 +2859,316 @@ def is_valid_executable(filename):
     return False
 
 
+PIN_LAYOUTS = ('round-robin', 'socket')
+
+
+def available_cpus():
+    '''returns a sorted list of the cpus this process may run on'''
+    try:
+        return sorted(os.sched_getaffinity(0))
+    except AttributeError:
+        pass
+    # e.g. restricted to a cpuset by a batch scheduler
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('Cpus_allowed_list:'):
+                    return _parse_cpu_list(line.split(':', 1)[1])
+    except (IOError, ValueError):
+        pass
+    return range(multiprocessing.cpu_count())
+
+
+def _parse_cpu_list(spec):
+    '''parses a list of cpus such as 0-3,8,10-11 into a sorted list'''
+    cpus = set()
+    for part in spec.strip().split(','):
+        if not part:
+            continue
+        first, _, last = part.partition('-')
+        cpus.update(xrange(int(first), int(last or first) + 1))
+    return sorted(cpus)
+
+
+def _cpu_sockets(cpus):
+    '''
+    groups cpus by physical package (socket) using sysfs
+
+    returns a list of lists, one per socket. If the topology cannot be read
+    all cpus are placed on a single socket
+    '''
+    sockets = {}
+    for cpu in cpus:
+        topology = os.path.join('/sys/devices/system/cpu',
+                                'cpu%d' % cpu, 'topology',
+                                'physical_package_id')
+        try:
+            with open(topology) as f:
+                socket_id = int(f.read().strip())
+        except (IOError, OSError, ValueError):
+            socket_id = 0
+        sockets.setdefault(socket_id, []).append(cpu)
+    return [sockets[k] for k in sorted(sockets)]
+
+
+def cpu_layout(num_workers, layout='round-robin', cpus=None):
+    '''
+    returns a list of cpu sets, one per worker
+
+    round-robin assigns each worker a single core, wrapping around if there
+    are more workers than cores. socket assigns each worker every core of one
+    socket, alternating between sockets so memory bandwidth is spread out
+    '''
+    if cpus is None:
+        cpus = available_cpus()
+    if len(cpus) == 0:
+        return [None] * num_workers
+    if layout == 'round-robin':
+        return [set([cpus[i % len(cpus)]]) for i in xrange(num_workers)]
+    elif layout == 'socket':
+        sockets = _cpu_sockets(cpus)
+        return [set(sockets[i % len(sockets)]) for i in xrange(num_workers)]
+    else:
+        raise ValueError('Unknown pinning layout %s' % layout)
+
+
+def _pinning_queue(num_workers, layout):
+    '''
+    returns a queue holding cpu_layout(num_workers, layout), from which
+    each worker takes its cpu set in _pin_worker (None if unsupported)
+
+    a queue is used so that every worker gets a different entry. The
+    planned mapping is logged by the parent
+    '''
+    if not hasattr(os, 'sched_setaffinity'):
+        try:
+            _path_to_executable('taskset')
+        except StandardError:
+            warning('CPU pinning is not supported on this platform. '
+                    'Workers will not be pinned.')
+            return None
+    mapping = cpu_layout(num_workers, layout)
+    info('Pinning %d workers (%s): %s', num_workers, layout,
+         '; '.join(','.join(str(c) for c in sorted(cpu_set))
+                   for cpu_set in mapping))
+    cpu_sets = multiprocessing.Queue()
+    for cpu_set in mapping:
+        cpu_sets.put(cpu_set)
+    return cpu_sets
+
+
+def _init_worker(log_queue=None, cpu_sets=None, child_slots=None):
+    '''
+    Pool initializer
+
+    sends the worker's log records to log_queue, pins it to a cpu set
+    from cpu_sets and shares the parent's limit on child processes (see
+    set_max_children), if given
+    '''
+    global _CHILD_SLOTS
+    if log_queue is not None:
+        _log_to_queue(log_queue)
+    if cpu_sets is not None:
+        _pin_worker(cpu_sets)
+    _CHILD_SLOTS = child_slots
+
+
+def _pin_worker(cpu_sets):
+    '''pins the current worker to the next cpu set'''
+    try:
+        cpu_set = cpu_sets.get(timeout=1)
+    except Queue.Empty:
+        # the pool replaced a worker and the queue is exhausted
+        return
+    if cpu_set is None:
+        return
+    try:
+        _set_affinity(cpu_set)
+    except (OSError, subprocess.CalledProcessError), err:
+        warning('Could not pin %s to cpus %s: %s',
+                multiprocessing.current_process().name,
+                ','.join(str(c) for c in sorted(cpu_set)), err)
+        return
+    info('Pinned %s to cpus %s', multiprocessing.current_process().name,
+         ','.join(str(c) for c in sorted(cpu_set)))
+
+
+def _set_affinity(cpu_set):
+    '''
+    pins the current process to cpu_set
+
+    uses os.sched_setaffinity where available, otherwise falls back on
+    taskset(1)
+    '''
+    try:
+        os.sched_setaffinity(0, cpu_set)
+    except AttributeError:
+        cpu_list = ','.join(str(c) for c in sorted(cpu_set))
+        with open(os.devnull, 'w') as devnull:
+            subprocess.check_call(['taskset', '-pc', cpu_list,
+                                   str(os.getpid())], stdout=devnull)
+
+
+# (semaphore, lock, limit) shared with pool workers, see set_max_children
+_CHILD_SLOTS = None
+
+ProcessStats = collections.namedtuple('ProcessStats', ['args', 'returncode',
+                                                       'user_time',
+                                                       'system_time',
+                                                       'max_rss'])
+
+
+def set_max_children(limit):
+    '''
+    limits the number of external programs run by run_pipeline at once
+
+    the limit applies to this process and to the workers of any pool it
+    starts afterwards. None removes the limit
+    '''
+    global _CHILD_SLOTS
+    if limit is None:
+        _CHILD_SLOTS = None
+    else:
+        _CHILD_SLOTS = (multiprocessing.BoundedSemaphore(limit),
+                        multiprocessing.Lock(), limit)
+
+
+def _acquire_children(n):
+    if _CHILD_SLOTS is None:
+        return
+    semaphore, lock, limit = _CHILD_SLOTS
+    if n > limit:
+        raise ValueError('Cannot run %d programs at once with '
+                         '--max-children %d' % (n, limit))
+    # take all the slots at once so that pipelines can't deadlock
+    with lock:
+        for _ in xrange(n):
+            semaphore.acquire()
+
+
+def _release_children(n):
+    if _CHILD_SLOTS is None:
+        return
+    for _ in xrange(n):
+        _CHILD_SLOTS[0].release()
+
+
+def _set_pipe_size(f, size):
+    '''grows the kernel buffer of pipe f to size bytes (Linux only)'''
+    try:
+        import fcntl
+        # F_SETPIPE_SZ, not exported by fcntl before python 3.10
+        fcntl.fcntl(f.fileno(), getattr(fcntl, 'F_SETPIPE_SZ', 1031), size)
+    except (ImportError, IOError):
+        pass
+
+
+def _wait(process):
+    '''
+    waits for process and returns its ProcessStats, using os.wait4 to
+    collect its resource usage where available
+    '''
+    args = process.args
+    try:
+        while True:
+            try:
+                _, status, usage = os.wait4(process.pid, 0)
+                break
+            except OSError, err:
+                if err.errno != errno.EINTR:
+                    raise
+    except AttributeError:
+        process.wait()
+        return ProcessStats(args, process.returncode, None, None, None)
+    if os.WIFSIGNALED(status):
+        process.returncode = -os.WTERMSIG(status)
+    else:
+        process.returncode = os.WEXITSTATUS(status)
+    stats = ProcessStats(args, process.returncode, usage.ru_utime,
+                         usage.ru_stime, usage.ru_maxrss)
+    debug('%s exited with %d (user %.2fs, system %.2fs, max rss %d)',
+          args[0], stats.returncode, stats.user_time, stats.system_time,
+          stats.max_rss)
+    return stats
+
+
+def run_pipeline(commands, stdin=None, stdout=None, stderr=None, check=True,
+                 pipe_size=1 << 20, **popen_kwargs):
+    '''
+    runs commands (lists of arguments) with each one's stdout piped into
+    the next one's stdin, and returns a ProcessStats for each
+
+    data flows directly between the programs through pipes of pipe_size
+    bytes, never through python. stdin, stdout and stderr may be file
+    names, file objects or None (inherit). Respects set_max_children
+    (--max-children). If check, raises subprocess.CalledProcessError if
+    any program fails; as in a shell, a program killed by SIGPIPE because
+    the next one stopped reading has not failed
+    '''
+    opened = []
+    preexec_fn = popen_kwargs.pop('preexec_fn', None)
+
+    def restore_signals():
+        # python ignores SIGPIPE, and programs would inherit that
+        signal.signal(signal.SIGPIPE, signal.SIG_DFL)
+        if preexec_fn is not None:
+            preexec_fn()
+
+    def open_file(f, mode):
+        if isinstance(f, basestring):
+            f = open(f, mode)
+            opened.append(f)
+        return f
+    stdin = open_file(stdin, 'rb')
+    stdout = open_file(stdout, 'wb')
+    stderr = open_file(stderr, 'wb')
+    _acquire_children(len(commands))
+    processes = []
+    try:
+        previous = stdin
+        for i, args in enumerate(commands):
+            last = i == len(commands) - 1
+            process = subprocess.Popen(args, stdin=previous,
+                                       stdout=stdout if last else
+                                       subprocess.PIPE,
+                                       stderr=stderr, close_fds=True,
+                                       preexec_fn=restore_signals,
+                                       **popen_kwargs)
+            process.args = args
+            if i > 0:
+                # only the next program should hold this end of the pipe
+                previous.close()
+            if not last:
+                _set_pipe_size(process.stdout, pipe_size)
+            previous = process.stdout
+            processes.append(process)
+        stats = [_wait(child) for child in processes]
+    finally:
+        for process in processes:
+            if process.returncode is None:
+                process.kill()
+                _wait(process)
+        _release_children(len(commands))
+        for f in opened:
+            f.close()
+    if check:
+        for i, process_stats in enumerate(stats):
+            if process_stats.returncode == -signal.SIGPIPE and \
+                    i < len(stats) - 1:
+                continue
+            elif process_stats.returncode != 0:
+                raise subprocess.CalledProcessError(process_stats.returncode,
+                                                    process_stats.args)
+    return stats
+
+
+def run_command(args, **kwargs):
+    '''
+    runs a single program, see run_pipeline, and returns its ProcessStats
+    '''
+    return run_pipeline([args], **kwargs)[0]
+
+
 def usage_info():
     return ' '.join(['Usage:', PROGRAM_NAME, '[OPTIONS]', 'FILE(S)'])
 
@@ -753,13 +3198,208 @@ def valid_int(thing, msg, vmin, vmax):
 
 
 def extend_buffer(b, x, spacerlines=0):
-    """extends buffer b with string x, ignores if x is None"""
+    """
+    extends buffer b with string x, ignores if x is None
+
+    this copies b each time, so building large outputs with it is slow;
+    collect the pieces in a list (or use Environment.do_reduce) instead
+    """
     if b is None or x is None:
         return b
     else:
         return os.linesep.join([b] + [""]*spacerlines + [x])
 
 
+def tree_reduce(reducer, iterable):
+    """
+    combines the values of iterable, in order, with the associative
+    function reducer, skipping None
+
+    values are combined as a balanced tree, like a binary counter, so only
+    O(log n) partial results are held at once and each value takes part in
+    O(log n) combinations of similar size. Returns None for no values
+    """
+    # (level, value) pairs; levels strictly decrease towards the top
+    stack = []
+    for value in iterable:
+        if value is None:
+            continue
+        level = 0
+        while stack and stack[-1][0] == level:
+            value = reducer(stack.pop()[1], value)
+            level += 1
+        stack.append((level, value))
+    if not stack:
+        return None
+    value = stack.pop()[1]
+    while stack:
+        value = reducer(stack.pop()[1], value)
+    return value
+
+
+def _iter_chunks(iterable, chunk_size):
+    """yields successive lists of up to chunk_size items of iterable"""
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _iter_results(results, timeout=999999999):
+    """
+    iterates over the results of Pool.imap, waiting for each with a
+    timeout, which allows keyboard interrupt (set > 1 year)
+    """
+    while True:
+        try:
+            yield results.next(timeout)
+        except StopIteration:
+            return
+
+
+def _reduce_chunk(action, reducer, chunk, context):
+    return tree_reduce(reducer, (action(item, **context) for item in chunk))
+
+
+class SharedResult(object):
+    """
+    handle to an action result stored in a file in shared memory (see
+    share_result), which is all that gets pickled back to the parent
+
+    use it as a context manager to map the data without copying it; the
+    file is removed on exit
+    """
+    def __init__(self, path, size):
+        self.path = path
+        self.size = size
+        self._mapping = None
+
+    def __getstate__(self):
+        return {'path': self.path, 'size': self.size}
+
+    def __setstate__(self, state):
+        self.__init__(state['path'], state['size'])
+
+    def __len__(self):
+        return self.size
+
+    @contextlib.contextmanager
+    def mapped(self):
+        """context manager giving a read-only mmap of the data"""
+        with open(self.path, 'rb') as f:
+            if self.size == 0:
+                yield ''
+                return
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            yield data
+        finally:
+            data.close()
+
+    def read(self):
+        """returns a copy of the data as a str"""
+        with self.mapped() as data:
+            return data[:]
+
+    def release(self):
+        """removes the file holding the data"""
+        try:
+            os.remove(self.path)
+        except OSError, err:
+            if err.errno != ENOENT:
+                raise
+
+    def __enter__(self):
+        self._mapping = self.mapped()
+        return self._mapping.__enter__()
+
+    def __exit__(self, *exc_info):
+        try:
+            self._mapping.__exit__(*exc_info)
+        finally:
+            self._mapping = None
+            self.release()
+
+
+def share_result(data, directory=None):
+    """
+    writes data (a str or anything supporting the buffer interface) to a
+    file in shared memory and returns a SharedResult for it
+
+    the file goes in directory, the run's directory set up by do_action
+    (removed when the run ends), /dev/shm or the system temporary
+    directory, in that order of preference
+    """
+    if directory is None:
+        directory = os.environ.get('SCRIPTER_SHARED_DIR')
+    if directory is None and os.access('/dev/shm', os.W_OK):
+        directory = '/dev/shm'
+    fd, path = tempfile.mkstemp(prefix='scripter-result-', dir=directory)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+        size = f.tell()
+    return SharedResult(path, size)
+
+
+def _share_large_result(action, min_size, item, **context):
+    result = action(item, **context)
+    if isinstance(result, str) and len(result) >= min_size:
+        return share_result(result)
+    return result
+
+
+def _make_shared_dir(target_dir):
+    """
+    creates a directory for the run's shared results, in /dev/shm if
+    possible and in target_dir otherwise, and tells workers about it
+    """
+    if os.access('/dev/shm', os.W_OK):
+        parent = '/dev/shm'
+    else:
+        make_output_dirs([target_dir])
+        parent = target_dir
+    directory = tempfile.mkdtemp(prefix='scripter-', dir=parent)
+    os.environ['SCRIPTER_SHARED_DIR'] = directory
+    return directory
+
+
+def _remove_shared_dir(directory):
+    """removes directory, with any results that were never released"""
+    if os.environ.get('SCRIPTER_SHARED_DIR') == directory:
+        del os.environ['SCRIPTER_SHARED_DIR']
+    shutil.rmtree(directory, ignore_errors=True)
+
+
+def _write_shared_results(results, quiet=False, print_all=False):
+    """
+    prints the str results, one per line, writing SharedResults straight
+    from their mapping and releasing them
+
+    if print_all, any other result but None is printed as str(result),
+    and nothing at all is printed when there are no results
+    """
+    first = True
+    for result in results:
+        if isinstance(result, SharedResult):
+            with result as data:
+                if not quiet:
+                    if not first:
+                        sys.stdout.write(os.linesep)
+                    sys.stdout.write(buffer(data))
+        elif type(result) is str or print_all and result is not None:
+            if not quiet:
+                if not first:
+                    sys.stdout.write(os.linesep)
+                sys.stdout.write(str(result))
+        else:
+            continue
+        first = False
+    if not quiet and not (print_all and first):
+        sys.stdout.write('\n')
+
+
 def _iter_except(func, exception, first=None):
     """
     Taken from http://docs.python.org/library/itertools.html
@@ -813,14 +3453,403 @@ class AnnounceExitFilter(object):
         self._announce_exit = announce_exit
         super(AnnounceExitFilter, self).__init__()
 
+    _exit_prefixes = ('worker got sentinel', 'worker exiting',
+                      'recreated blocker', 'process shutting down',
+                      'running all "atexit"', 'DECREF')
+    _exit_suffixes = ('closing conn',)
+
     def filter(self, record):
-        if record.getMessage().startswith('worker got sentinel') or \
-           record.getMessage().startswith('worker exiting') or \
-           record.getMessage().startswith('recreated blocker') or \
-           record.getMessage().startswith('process shutting down') or \
-           record.getMessage().startswith('running all "atexit"') or \
-           record.getMessage().endswith('closing conn') or \
-           record.getMessage().startswith('DECREF'):
+        msg = record.getMessage()
+        if msg.startswith(self._exit_prefixes) or \
+           msg.endswith(self._exit_suffixes):
             return self._announce_exit
         else:
             return True
+
+
+def _log_to_queue(log_queue):
+    """
+    replaces the handlers on the current process's logger with a QueueHandler
+
+    handlers inherited from the parent are dropped so that only the parent's
+    LogListener writes log output
+    """
+    for handler in list(LOGGER.handlers):
+        LOGGER.removeHandler(handler)
+    handler = QueueHandler(log_queue)
+    LOGGER.addHandler(handler)
+    # run last; records logged after it, as the worker exits, are sent
+    # one by one
+    multiprocessing.util.Finalize(None, handler.close, exitpriority=-10)
+
+
+class QueueHandler(logging.Handler):
+    """
+    sends batches of log records to a queue, to be handled by a LogListener
+
+    records are buffered until capacity is reached or a record at
+    flush_level or above arrives, and a thread flushes them every
+    flush_interval seconds. Batches are written to the queue's pipe before
+    flush returns, so none are lost when the worker exits. Once closed
+    (when the worker exits, see _log_to_queue), records are not buffered
+    """
+    def __init__(self, queue, capacity=100, flush_interval=1.0,
+                 flush_level=logging.WARNING):
+        logging.Handler.__init__(self)
+        self.queue = queue
+        self.capacity = capacity
+        self.flush_interval = flush_interval
+        self.flush_level = flush_level
+        self._buffer = []
+        self._closed = False
+        thread = threading.Thread(target=self._flush_periodically)
+        thread.daemon = True
+        thread.start()
+
+    def _flush_periodically(self):
+        while not self._closed:
+            time.sleep(self.flush_interval)
+            self.flush()
+
+    def prepare(self, record):
+        """
+        makes record picklable by merging args and exc_info into msg
+        """
+        record.msg = self.format(record)
+        record.args = None
+        record.exc_info = None
+        return record
+
+    def emit(self, record):
+        try:
+            self._buffer.append(self.prepare(record))
+            if self._closed or len(self._buffer) >= self.capacity or \
+               record.levelno >= self.flush_level:
+                self.flush()
+        except (KeyboardInterrupt, SystemExit):
+            raise
+        except:
+            self.handleError(record)
+
+    def flush(self):
+        self.acquire()
+        try:
+            if self._buffer:
+                _send_directly(self.queue, self._buffer)
+                self._buffer = []
+        finally:
+            self.release()
+
+    def close(self):
+        self.acquire()
+        try:
+            self._closed = True
+            self.flush()
+        finally:
+            self.release()
+        logging.Handler.close(self)
+
+
+def _send_directly(queue, obj):
+    '''
+    writes obj to the pipe of a multiprocessing.Queue, without the feeder
+    thread used by put, which may still hold it when the process exits
+    '''
+    # get releases a slot for each object, as put would have taken
+    queue._sem.acquire()
+    if queue._wlock is not None:
+        queue._wlock.acquire()
+    try:
+        queue._writer.send(obj)
+    finally:
+        if queue._wlock is not None:
+            queue._wlock.release()
+
+
+class LogListener(object):
+    """
+    handles batches of records sent by QueueHandlers from a thread in the
+    parent process, so that only the parent writes log output
+    """
+    _sentinel = None
+
+    def __init__(self, queue, handlers):
+        self.queue = queue
+        self.handlers = list(handlers)
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._monitor)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def handle(self, record):
+        for handler in self.handlers:
+            if record.levelno >= handler.level:
+                handler.handle(record)
+
+    def _monitor(self):
+        while True:
+            batches = [self.queue.get()]
+            # drain whatever else is waiting before going back to sleep
+            batches.extend(_iter_except(self.queue.get_nowait, Queue.Empty))
+            for batch in batches:
+                if batch is self._sentinel:
+                    return
+                for record in batch:
+                    self.handle(record)
+
+    def stop(self, timeout=None):
+        """
+        handles everything already on the queue, then stops the thread
+
+        with a timeout, gives up after timeout seconds (e.g. when workers
+        were terminated and one may have died holding the queue's lock)
+        """
+        if timeout is not None:
+            self.queue.cancel_join_thread()
+        self.queue.put(self._sentinel)
+        self._thread.join(timeout)
+        self._thread = None
+
+
+def parse_address(spec, default_host=''):
+    '''parses [HOST:]PORT into (host, port)'''
+    host, _, port = spec.rpartition(':')
+    try:
+        return (host or default_host, int(port))
+    except ValueError:
+        raise Usage('%s is not of the form [HOST:]PORT' % spec)
+
+
+def _authkey(context):
+    if context.get('authkey') is None:
+        raise Usage('--serve and --connect need --authkey or '
+                    'SCRIPTER_AUTHKEY')
+    return context['authkey']
+
+
+# errors raised by a proxy whose coordinator has gone away
+_DISCONNECTED = (EOFError, IOError, OSError, socket.error)
+
+
+def _task_context(context):
+    '''
+    returns the context passed to actions along with each task
+
+    the options used to find the files are emptied: the list of files may
+    be long, and the context is pickled with every task
+    '''
+    return dict(context, files=[], files_from=None, include=None,
+                exclude=None)
+
+
+def _run_task(action, item, **context):
+    '''
+    runs action on item, returning (result, None) or (None, traceback)
+    '''
+    try:
+        return action(item, **context), None
+    except Exception:
+        return None, traceback.format_exc()
+
+
+ActionResult = collections.namedtuple('ActionResult', ['item', 'value',
+                                                       'elapsed', 'error'])
+
+
+def _run_indexed(action, task, context):
+    '''
+    runs action on the item of an (index, item) task from Environment.run
+    and returns (index, value, elapsed, error), without the item itself
+    '''
+    index, item = task
+    if item is None:
+        # a file that could not be parsed, already reported
+        return index, None, 0.0, None
+    start = time.time()
+    try:
+        value = action(item, **context)
+    except Exception:
+        return index, None, time.time() - start, traceback.format_exc()
+    return index, value, time.time() - start, None
+
+
+def _put_completed(completed, task_id, result):
+    completed.put((task_id, result))
+
+
+class _TaskTracker(object):
+    '''
+    runs tasks on pools with apply_async, and calls done(task_id, (value,
+    traceback)) as each finishes (see _run_task)
+
+    pools only call back with results they could send back, so a thread
+    looks for the other finished tasks (e.g. those returning values that
+    cannot be pickled) every poll_interval seconds and reports them as
+    failed
+    '''
+    def __init__(self, done, poll_interval=0.5):
+        self._done = done
+        self._poll_interval = poll_interval
+        self._lock = threading.Lock()
+        self._submitted = {}
+        self._ids = itertools.count()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._poll)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def submit(self, pool, task_id, action, item, context):
+        result = pool.apply_async(_run_task, (action, item), context,
+                                  callback=partial(self._done, task_id))
+        with self._lock:
+            self._submitted[next(self._ids)] = (task_id, result)
+
+    def _poll(self):
+        while not self._stopped.wait(self._poll_interval):
+            self.check()
+
+    def check(self):
+        '''
+        forgets the finished tasks, reporting those that failed without
+        calling back
+        '''
+        with self._lock:
+            finished = [key for key, (_, result)
+                        in self._submitted.iteritems() if result.ready()]
+            finished = [self._submitted.pop(key) for key in finished]
+        for task_id, result in finished:
+            if not result.successful():
+                try:
+                    result.get(0)
+                except Exception:
+                    self._done(task_id, (None, traceback.format_exc()))
+
+    def close(self):
+        '''stops the thread, and reports any task that failed meanwhile'''
+        self._stopped.set()
+        self._thread.join()
+        self.check()
+
+
+class _CoordinatorManager(multiprocessing.managers.BaseManager):
+    pass
+
+
+class Coordinator(object):
+    """
+    hands out the items of a sequence to remote workers (see --serve and
+    --connect) and collects their results
+
+    workers lease only as many tasks as they have idle processes, so
+    leases stay small and no task is run twice while its worker is alive.
+    Workers not heard from in worker_timeout seconds are dropped and their
+    leased tasks requeued; if such a worker comes back, whichever result
+    arrives first is kept. The items whose kept result is a failure are
+    listed in failed
+    """
+    exposed = ('get_context', 'next_tasks', 'put_result', 'heartbeat')
+
+    def __init__(self, sequence, context, worker_timeout=60, progress=None):
+        self._items = list(sequence)
+        self._progress = progress
+        self._context = dict(_task_context(context), serve=None,
+                             connect=None, authkey=None)
+        self._worker_timeout = worker_timeout
+        self._lock = threading.Lock()
+        self._pending = collections.deque(xrange(len(self._items)))
+        self._leases = {}
+        self._last_seen = {}
+        self._finished = set()
+        self._results = {}
+        self.failed = []
+        self._done = threading.Event()
+        if not self._items:
+            self._done.set()
+
+    def __len__(self):
+        return len(self._items)
+
+    def get_context(self):
+        return self._context
+
+    def heartbeat(self, worker_id):
+        with self._lock:
+            self._touch(worker_id)
+
+    def next_tasks(self, worker_id, n=1):
+        """
+        leases up to n tasks to worker_id and returns them as a list of
+        (task_id, item). Returns None once every task has a result
+        """
+        with self._lock:
+            self._touch(worker_id)
+            self._reap()
+            if self._done.is_set():
+                self._finished.add(worker_id)
+                return None
+            task_ids = []
+            while self._pending and len(task_ids) < n:
+                task_id = self._pending.popleft()
+                if task_id not in self._results:
+                    task_ids.append(task_id)
+            self._leases[worker_id].extend(task_ids)
+            return [(i, self._items[i]) for i in task_ids]
+
+    def put_result(self, worker_id, task_id, value, tb=None):
+        with self._lock:
+            self._touch(worker_id)
+            lease = self._leases[worker_id]
+            if task_id in lease:
+                lease.remove(task_id)
+            if task_id in self._results:
+                return
+            if tb is not None:
+                error('%s failed on %r:\n%s', worker_id,
+                      self._items[task_id], tb)
+                self.failed.append(self._items[task_id])
+            self._results[task_id] = value
+            if self._progress is not None:
+                self._progress.update(self._items[task_id])
+            if len(self._results) == len(self._items):
+                self._done.set()
+
+    def wait(self):
+        """
+        blocks until every task has a result and every live worker has
+        been told so, then returns the results in order
+        """
+        while not self._done.wait(self._worker_timeout / 3.0):
+            with self._lock:
+                self._reap()
+                debug('%d of %d tasks done, %d workers connected',
+                      len(self._results), len(self._items),
+                      len(self._last_seen))
+        # give the workers a chance to hear that we're done
+        deadline = time.time() + self._worker_timeout
+        while time.time() < deadline:
+            with self._lock:
+                self._reap()
+                if set(self._last_seen) <= self._finished:
+                    break
+            time.sleep(0.1)
+        return [self._results[task_id] for task_id in xrange(len(self))]
+
+    def _touch(self, worker_id):
+        if worker_id not in self._last_seen:
+            info('Worker %s connected', worker_id)
+            self._leases[worker_id] = []
+        self._last_seen[worker_id] = time.time()
+
+    def _reap(self):
+        now = time.time()
+        for worker_id, last_seen in self._last_seen.items():
+            if now - last_seen > self._worker_timeout:
+                lease = [task_id for task_id in self._leases.pop(worker_id)
+                         if task_id not in self._results]
+                del self._last_seen[worker_id]
+                self._finished.discard(worker_id)
+                warning('Worker %s stopped responding. Requeueing its %d '
+                        'tasks', worker_id, len(lease))
+                self._pending.extendleft(reversed(lease))